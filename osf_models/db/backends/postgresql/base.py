@@ -1,6 +1,8 @@
+import threading
 import uuid
 
 import psycopg2
+import psycopg2.extras
 from django.conf import settings
 from django.db.backends.postgresql.base import (
     DatabaseWrapper as PostgresqlDatabaseWrapper
@@ -10,14 +12,26 @@ from django.db.backends.postgresql.base import utc_tzinfo_factory
 
 class server_side_cursors(object):
     """
-    With block helper that enables and disables server side cursors.
+    With block helper that enables server side cursors for the cursors created on this
+    thread inside the block. Blocks can be nested; the innermost one wins.
+
+    With ``once=True`` only the first cursor created in the block is a server side
+    cursor, which is how ``MODMCompatibilityQuerySet.stream`` limits it to its own query.
+
+    ``row_factory`` is one of 'dict' (psycopg2's DictRows, which also index like tuples),
+    'namedtuple' or 'tuple', the cheapest. Django only reads rows by position, so
+    querysets work with any of them.
     """
 
-    def __init__(self, qs_or_using_or_connection, itersize=2000):
+    def __init__(self, qs_or_using_or_connection, itersize=2000, once=False, row_factory='dict'):
         from django.db import connections
         from django.db.models.query import QuerySet
 
+        if row_factory not in ROW_FACTORIES:
+            raise ValueError('row_factory must be one of {}'.format(', '.join(sorted(ROW_FACTORIES))))
         self.itersize = itersize
+        self.once = once
+        self.row_factory = row_factory
         if isinstance(qs_or_using_or_connection, QuerySet):
             self.connection = connections[qs_or_using_or_connection.db]
         elif isinstance(qs_or_using_or_connection, basestring):
@@ -26,12 +40,40 @@ class server_side_cursors(object):
             self.connection = qs_or_using_or_connection
 
     def __enter__(self):
-        self.connection.server_side_cursors = True
-        self.connection.server_side_cursor_itersize = self.itersize
+        self.connection.push_server_side_cursors(self.itersize, once=self.once, row_factory=self.row_factory)
 
     def __exit__(self, type, value, traceback):
-        self.connection.server_side_cursors = False
-        self.connection.server_side_cursor_itersize = None
+        self.connection.pop_server_side_cursors()
+
+
+class ItersizeFetchManyMixin(object):
+    """
+    Makes a named cursor fetch at least ``itersize`` rows per round trip. Django's
+    iterator() fetches 100 rows at a time, which would make itersize moot.
+    """
+
+    def fetchmany(self, size=None):
+        return super(ItersizeFetchManyMixin, self).fetchmany(max(size or self.arraysize, self.itersize))
+
+
+class ServerSideCursor(ItersizeFetchManyMixin, psycopg2.extensions.cursor):
+    pass
+
+
+class ServerSideNamedTupleCursor(ItersizeFetchManyMixin, psycopg2.extras.NamedTupleCursor):
+    pass
+
+
+class ServerSideDictCursor(ItersizeFetchManyMixin, psycopg2.extras.DictCursor):
+    pass
+
+
+# Row types server side cursors can return -> cursor class
+ROW_FACTORIES = {
+    'tuple': ServerSideCursor,
+    'namedtuple': ServerSideNamedTupleCursor,
+    'dict': ServerSideDictCursor,
+}
 
 
 class DatabaseWrapper(PostgresqlDatabaseWrapper):
@@ -44,23 +86,68 @@ class DatabaseWrapper(PostgresqlDatabaseWrapper):
     with server_side_cursors(qs, itersize=x):
         for item in qs.iterator():
             item.value
+
+    Rows come back as psycopg2 DictRows unless another row_factory is given, e.g.
+
+    with server_side_cursors(connection, row_factory='namedtuple'):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, title FROM osf_models_abstractnode')
+            for row in cursor:
+                row.title
+
+    or, to use a server side cursor for that one query only:
+
+    for item in Model.objects.all().stream(itersize=x):
+        item.value
     """
 
     def __init__(self, *args, **kwargs):
-        self.server_side_cursors = False
-        self.server_side_cursor_itersize = None
+        # server_side_cursors blocks, per thread
+        self._server_side_cursor_state = threading.local()
 
         super(DatabaseWrapper, self).__init__(*args, **kwargs)
 
+    @property
+    def _server_side_cursor_stack(self):
+        state = self._server_side_cursor_state
+        if not hasattr(state, 'stack'):
+            state.stack = []
+        return state.stack
+
+    def push_server_side_cursors(self, itersize, once=False, row_factory='dict'):
+        self._server_side_cursor_stack.append({
+            'itersize': itersize,
+            'once': once,
+            'row_factory': row_factory,
+            'used': False,
+        })
+
+    def pop_server_side_cursors(self):
+        self._server_side_cursor_stack.pop()
+
+    @property
+    def server_side_cursors(self):
+        stack = self._server_side_cursor_stack
+        return bool(stack) and not stack[-1]['used']
+
+    @property
+    def server_side_cursor_itersize(self):
+        stack = self._server_side_cursor_stack
+        return stack[-1]['itersize'] if stack else None
+
     def create_cursor(self):
         if not self.server_side_cursors:
             return super(DatabaseWrapper, self).create_cursor()
 
+        block = self._server_side_cursor_stack[-1]
+        if block['once']:
+            block['used'] = True
+
         cursor = self.connection.cursor(
             name='osf_models.db.backends.postgresql_cursors:{}'.format(
                 uuid.uuid4().hex),
-            cursor_factory=psycopg2.extras.DictCursor, )
+            cursor_factory=ROW_FACTORIES[block['row_factory']], )
         cursor.tzinfo_factory = utc_tzinfo_factory if settings.USE_TZ else None
-        cursor.itersize = self.server_side_cursor_itersize
+        cursor.itersize = block['itersize']
 
         return cursor
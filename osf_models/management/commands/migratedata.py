@@ -1,82 +1,158 @@
 import gc
 import importlib
+import multiprocessing
 import sys
+import time
 
 import ipdb
+from django.apps import apps
 from django.core.management import BaseCommand
+from django.db import connections
 from django.db import transaction
 from django.utils import timezone
 from modularodm import Q as MQ
+from modularodm import StoredObject
+from modularodm.storage import MongoStorage
 from osf_models.models import ApiOAuth2Scope
 from osf_models.models import Guid
+from osf_models.models import MigrationCheckpoint
 from osf_models.models import NodeLog
 from osf_models.models import NotificationSubscription
 from osf_models.models import Tag
+from osf_models.models.base import BaseModel
 from osf_models.models.base import GuidMixin
 from osf_models.models.contributor import AbstractBaseContributor
+from osf_models.utils.bulk_writers import WRITERS
+from osf_models.utils.bulk_writers import get_writer
+from osf_models.utils.deferred_indexes import deferred_indexes
+from osf_models.utils.migration_metrics import MigrationMetrics
+from osf_models.utils.order_apps import get_dependency_graph
 from osf_models.utils.order_apps import get_ordered_models
+from pymongo import MongoClient
 
+import framework.mongo
 from framework.auth.core import User as MODMUser
+from framework.mongo import handlers as mongo_handlers
 from framework.transactions.context import transaction as modm_transaction
+from website import settings as website_settings
 from website.files.models import StoredFileNode
 from website.models import Node as MODMNode
 
 
-def make_guids(django_model, page_size=20000):
-    print('Starting {} on {}...'.format(sys._getframe().f_code.co_name, django_model._meta.model.__name__))
-
+def get_modm_model(django_model):
     module_path, model_name = django_model.modm_model_path.rsplit('.', 1)
     modm_module = importlib.import_module(module_path)
-    modm_model = getattr(modm_module, model_name)
+    return getattr(modm_module, model_name)
+
+
+def find_page(modm_model, modm_query, last_id, page_size):
+    """
+    Get the page of modm objects that follows last_id, sorted by descending _id.
+
+    Pages are found by _id rather than by offset so that mongo can seek straight to the
+    start of each page instead of scanning every object that came before it.
+    :param modm_model: modm model to query
+    :param modm_query: query for the objects being migrated, or None
+    :param last_id: _id of the last object on the previous page, or None for the first page
+    :param page_size: number of objects per page
+    :return: modm queryset
+    """
+    if last_id is not None:
+        after_last_id = MQ('_id', 'lt', last_id)
+        modm_query = after_last_id if modm_query is None else modm_query & after_last_id
+    return modm_model.find(modm_query).sort('-_id')[0:page_size]
 
-    count = 0
+
+def make_guids(django_model, page_size=20000, writer='bulk_create', resume=False, metrics=None):
+    print('Starting {} on {}...'.format(sys._getframe().f_code.co_name, django_model._meta.model.__name__))
+    metrics = metrics or MigrationMetrics()
+
+    checkpoint = MigrationCheckpoint.start(django_model, MigrationCheckpoint.GUIDS, resume=resume)
+    if checkpoint.finished:
+        print('Already finished {} on {}, skipping...'.format(sys._getframe().f_code.co_name,
+                                                               django_model._meta.model.__name__))
+        return
+
+    modm_model = get_modm_model(django_model)
+    guid_writer = get_writer(writer, Guid)
+
+    count = checkpoint.object_count
     total = modm_model.find(django_model.modm_query).count()
+    last_id = checkpoint.last_id
+    if last_id is not None:
+        print('Resuming {} from {} after {} objects...'.format(django_model._meta.model.__name__, last_id, count))
 
     while count < total:
         with transaction.atomic():
             django_objects = list()
-            offset = count
-            limit = (count + page_size) if (count + page_size) < total else total
-
-            page_of_modm_objects = modm_model.find(django_model.modm_query).sort('-_id')[offset:limit]
+            page_start_time = time.time()
+            bytes_read = 0
 
-            for modm_obj in page_of_modm_objects:
+            for modm_obj in find_page(modm_model, django_model.modm_query, last_id, page_size):
                 django_objects.append(Guid(**{django_model.primary_identifier_name: modm_obj._id}))
+                bytes_read += metrics.sample_size(modm_obj)
+                last_id = modm_obj._id
                 count += 1
-                if count % page_size == 0 or count == total:
-                    page_finish_time = timezone.now()
-                    print('Saving Guids for {} {} through {}...'.format(django_model._meta.model.__name__,
-                                                                        count - page_size,
-                                                                        count))
-                    saved = Guid.objects.bulk_create(django_objects)
-                    print('Done with {} {} in {} seconds...'.format(len(saved),
-                                                                    django_model._meta.model.__name__, (
-                                                                        timezone.now() - page_finish_time).total_seconds()))
-                    modm_obj._cache.clear()
-                    modm_obj._object_cache.clear()
-                    django_objects = []
-                    print('Took out {} trashes'.format(gc.collect()))
+
+            if not django_objects:
+                # objects were removed since we counted them
+                break
+
+            page_finish_time = time.time()
+            print('Saving Guids for {} {} through {}...'.format(django_model._meta.model.__name__,
+                                                                count - len(django_objects),
+                                                                count))
+            saved = guid_writer.write(django_objects)
+            checkpoint.advance(last_id, len(django_objects))
+            write_seconds = time.time() - page_finish_time
+            print('Done with {} {} in {} seconds...'.format(saved,
+                                                            django_model._meta.model.__name__, write_seconds))
+            modm_model._cache.clear()
+            modm_model._object_cache.clear()
+            rows_read = len(django_objects)
+            django_objects = []
+            collected, gc_seconds = metrics.collect_garbage()
+            print('Took out {} trashes'.format(collected))
+        metrics.page(django_model._meta.model.__name__, MigrationCheckpoint.GUIDS, rows_read, saved, bytes_read,
+                     page_finish_time - page_start_time, write_seconds, gc_seconds)
+    checkpoint.finish()
+    metrics.finish(django_model._meta.model.__name__, MigrationCheckpoint.GUIDS)
     total = None
     count = None
     print('Took out {} trashes'.format(gc.collect()))
 
 
-def save_bare_models(modm_queryset, django_model, page_size=20000):
+def save_bare_models(modm_model, django_model, page_size=20000, writer='bulk_create', resume=False, metrics=None):
     print('Starting {} on {}...'.format(sys._getframe().f_code.co_name, django_model._meta.model.__name__))
-    count = 0
-    total = modm_queryset.count()
+    metrics = metrics or MigrationMetrics()
+
+    checkpoint = MigrationCheckpoint.start(django_model, MigrationCheckpoint.BARE_MODELS, resume=resume)
+    if checkpoint.finished:
+        print('Already finished {} on {}, skipping...'.format(sys._getframe().f_code.co_name,
+                                                               django_model._meta.model.__name__))
+        return
+
+    count = checkpoint.object_count
+    total = modm_model.find(django_model.modm_query).count()
+    last_id = checkpoint.last_id
     hashes = set()
+    django_writer = get_writer(writer, django_model)
+
+    if last_id is not None:
+        print('Resuming {} from {} after {} objects...'.format(django_model._meta.model.__name__, last_id, count))
+        if django_model._natural_key.__func__ is not BaseModel._natural_key.__func__:
+            # rebuild the natural keys of what's already been saved so it isn't saved twice
+            hashes = set(django_obj._natural_key() for django_obj in django_model.objects.all().iterator())
 
     while count < total:
         with transaction.atomic():
             django_objects = list()
+            page_count = 0
+            page_start_time = time.time()
+            bytes_read = 0
 
-            offset = count
-            limit = (count + page_size) if (count + page_size) < total else total
-
-            page_of_modm_objects = modm_queryset.sort('-_id')[offset:limit]
-
-            for modm_obj in page_of_modm_objects:
+            for modm_obj in find_page(modm_model, django_model.modm_query, last_id, page_size):
+                bytes_read += metrics.sample_size(modm_obj)
                 django_instance = django_model.migrate_from_modm(modm_obj)
                 if django_instance._natural_key() is not None:
                     # if there's a natural key
@@ -89,31 +165,47 @@ def save_bare_models(modm_queryset, django_model, page_size=20000):
                     # if _natural_key is None add it, it's probably pointing at .pk
                     django_objects.append(django_instance)
 
+                last_id = modm_obj._id
+                page_count += 1
                 count += 1
-                if count % page_size == 0 or count == total:
-                    page_finish_time = timezone.now()
-                    print('Saving {} {} through {}...'.format(django_model._meta.model.__name__, count - page_size,
-                                                              count))
-                    saved_django_objects = django_model.objects.bulk_create(django_objects)
-
-                    print('Done with {} {} in {} seconds...'.format(len(saved_django_objects),
-                                                                    django_model._meta.model.__name__, (
-                                                                        timezone.now() - page_finish_time).total_seconds()))
-                    modm_obj._cache.clear()
-                    modm_obj._object_cache.clear()
-                    saved_django_objects = []
-                    page_of_modm_objects = []
-                    print('Took out {} trashes'.format(gc.collect()))
+
+            if not page_count:
+                # objects were removed since we counted them
+                break
+
+            page_finish_time = time.time()
+            print('Saving {} {} through {}...'.format(django_model._meta.model.__name__, count - page_count,
+                                                      count))
+            saved_django_objects = django_writer.write(django_objects)
+            checkpoint.advance(last_id, page_count)
+            write_seconds = time.time() - page_finish_time
+
+            print('Done with {} {} in {} seconds...'.format(saved_django_objects,
+                                                            django_model._meta.model.__name__, write_seconds))
+            modm_model._cache.clear()
+            modm_model._object_cache.clear()
+            django_objects = []
+            collected, gc_seconds = metrics.collect_garbage()
+            print('Took out {} trashes'.format(collected))
+        metrics.page(django_model._meta.model.__name__, MigrationCheckpoint.BARE_MODELS, page_count,
+                     saved_django_objects, bytes_read, page_finish_time - page_start_time, write_seconds, gc_seconds)
+    checkpoint.finish()
+    metrics.finish(django_model._meta.model.__name__, MigrationCheckpoint.BARE_MODELS)
     total = None
     count = None
     hashes = None
     print('Took out {} trashes'.format(gc.collect()))
 
 
-def save_bare_system_tags(page_size=10000):
+def save_bare_system_tags(page_size=10000, resume=False):
     print('Starting save_bare_system_tags...')
     start = timezone.now()
 
+    checkpoint = MigrationCheckpoint.start(Tag, MigrationCheckpoint.SYSTEM_TAGS, resume=resume)
+    if checkpoint.finished:
+        print('Already finished save_bare_system_tags, skipping...')
+        return
+
     things = list(MODMNode.find(MQ('system_tags', 'ne', [])).sort(
         '-_id')) + list(MODMUser.find(MQ('system_tags', 'ne', [])).sort(
         '-_id'))
@@ -132,7 +224,9 @@ def save_bare_system_tags(page_size=10000):
         system_tags.append(Tag(name=system_tag_id,
                                system=True))
 
-    created_system_tags = Tag.objects.bulk_create(system_tags)
+    with transaction.atomic():
+        created_system_tags = Tag.objects.bulk_create(system_tags)
+        checkpoint.finish()
 
     print('MODM System Tags: {}'.format(total))
     print('django system tags: {}'.format(Tag.objects.filter(system=True).count()))
@@ -243,12 +337,149 @@ def merge_duplicate_users():
         (timezone.now() - start).total_seconds()))
 
 
+def should_migrate(django_model, options):
+    if not options['nodelogs'] and not options['nodelogsguids'] and django_model is NodeLog:
+        return False
+    elif (options['nodelogs'] or options['nodelogsguids']) and django_model is not NodeLog:
+        return False
+
+    if issubclass(django_model, AbstractBaseContributor) \
+            or django_model is ApiOAuth2Scope \
+            or not hasattr(django_model, 'modm_model_path'):
+        return False
+    return True
+
+
+def migrate_model(django_model, options, metrics):
+    modm_model = get_modm_model(django_model)
+
+    if hasattr(django_model, 'primary_identifier_name') and \
+            not issubclass(django_model, GuidMixin) and \
+            django_model is not NotificationSubscription:
+        if not options['nodelogs']:
+            make_guids(django_model, page_size=django_model.migration_page_size, writer=options['writer'],
+                       resume=options['resume'], metrics=metrics)
+    if not options['nodelogsguids']:
+        save_bare_models(modm_model, django_model, page_size=django_model.migration_page_size,
+                         writer=options['writer'], resume=options['resume'], metrics=metrics)
+    modm_model._cache.clear()
+    modm_model._object_cache.clear()
+    print('Took out {} trashes'.format(gc.collect()))
+
+
+def reconnect_modm():
+    """Point modm's storage backends at a new MongoClient. pymongo clients aren't fork
+    safe, so a worker can't keep using the one it inherited from the parent.
+    """
+    client = MongoClient(website_settings.DB_HOST, website_settings.DB_PORT)
+    database = client[website_settings.DB_NAME]
+    db_user = getattr(website_settings, 'DB_USER', None)
+    db_pass = getattr(website_settings, 'DB_PASS', None)
+    if db_user and db_pass:
+        database.authenticate(db_user, db_pass)
+    for modm_model in StoredObject._collections.values():
+        for storage in getattr(modm_model, '_storage', None) or ():
+            if isinstance(storage, MongoStorage):
+                storage.db = database
+    # For code that uses the database handle directly instead of through the models
+    framework.mongo.database = database
+    mongo_handlers.database = database
+
+
+def init_worker():
+    # Connections inherited from the parent process can't be shared,
+    # make each worker open its own.
+    connections.close_all()
+    reconnect_modm()
+
+
+def migrate_model_in_worker(model_label, options):
+    start = timezone.now()
+    metrics = MigrationMetrics(options['metrics_file'])
+    migrate_model(apps.get_model(model_label), options, metrics)
+    # hand the model's metrics back for the summary
+    return (timezone.now() - start).total_seconds(), metrics.records
+
+
+def migrate_models_in_parallel(models, options, workers, metrics):
+    """
+    Migrate models in a pool of worker processes. A model is only handed to a worker once
+    every model it depends on has finished.
+    :param models: models to migrate
+    :param options: command options
+    :param workers: number of worker processes
+    :param metrics: MigrationMetrics that the workers' metrics are added to
+    :return:
+    """
+    print('Starting {} on {} models with {} workers...'.format(sys._getframe().f_code.co_name, len(models), workers))
+    start = timezone.now()
+
+    # only hand picklable options down to the workers
+    worker_options = {key: options[key] for key in ('nodelogs', 'nodelogsguids', 'writer', 'resume', 'metrics_file')}
+    dependencies = get_dependency_graph(models)
+    pending = list(models)
+    running = {}
+    finished = set()
+
+    # don't hand our connections down to the workers
+    connections.close_all()
+    pool = multiprocessing.Pool(workers, initializer=init_worker)
+    try:
+        while pending or running:
+            for django_model in list(pending):
+                if dependencies.get(django_model, set()) <= finished:
+                    pending.remove(django_model)
+                    running[django_model] = pool.apply_async(
+                        migrate_model_in_worker, (django_model._meta.label, worker_options))
+                    print('Queued {}...'.format(django_model._meta.model.__name__))
+
+            for django_model, result in running.items():
+                if not result.ready():
+                    continue
+                # re-raises any exception from the worker
+                seconds, records = result.get()
+                metrics.add(records)
+                del running[django_model]
+                finished.add(django_model)
+                print('Done with {} in {} seconds ({} of {} models)...'.format(
+                    django_model._meta.model.__name__, seconds, len(finished), len(models)))
+
+            if pending and not running:
+                raise Exception('Can\'t resolve dependencies for {}'.format(
+                    ', '.join(model._meta.model.__name__ for model in pending)))
+            time.sleep(1)
+    except Exception:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    print('Done with {} in {} seconds...'.format(
+        sys._getframe().f_code.co_name,
+        (timezone.now() - start).total_seconds()))
+
+
 class Command(BaseCommand):
     help = 'Migrates data from tokumx to postgres'
 
     def add_arguments(self, parser):
         parser.add_argument('--nodelogs', action='store_true', help='Run nodelog migrations')
         parser.add_argument('--nodelogsguids', action='store_true', help='Run nodelog guid migrations')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes to migrate independent models with')
+        parser.add_argument('--writer', choices=sorted(WRITERS), default='bulk_create',
+                            help='How to insert migrated rows, copy streams them in with COPY FROM STDIN')
+        parser.add_argument('--resume', action='store_true',
+                            help='Skip finished models and continue partial ones from their last checkpoint')
+        parser.add_argument('--defer-indexes', action='store_true',
+                            help='Drop non-unique indexes and FK constraints while loading and rebuild them after')
+        parser.add_argument('--index-state-file', default='deferred_indexes.json',
+                            help='Where --defer-indexes saves what it dropped until it is rebuilt. Anything '
+                                 'listed there by a run that died is rebuilt by the next one.')
+        parser.add_argument('--metrics-file',
+                            help='Append per page and per model metrics here as JSON lines instead of printing them')
 
 
     def handle(self, *args, **options):
@@ -266,35 +497,32 @@ class Command(BaseCommand):
             # merged users get blank usernames, running it twice fixes it.
             merge_duplicate_users()
 
-        for django_model in models:
-
-            if not options['nodelogs'] and not options['nodelogsguids'] and django_model is NodeLog:
-                continue
-            elif (options['nodelogs'] or options['nodelogsguids']) and django_model is not NodeLog:
-                continue
-
-            if issubclass(django_model, AbstractBaseContributor) \
-                    or django_model is ApiOAuth2Scope \
-                    or not hasattr(django_model, 'modm_model_path'):
-                continue
-
-            module_path, model_name = django_model.modm_model_path.rsplit('.', 1)
-            modm_module = importlib.import_module(module_path)
-            modm_model = getattr(modm_module, model_name)
-            modm_queryset = modm_model.find(django_model.modm_query)
-
-            with ipdb.launch_ipdb_on_exception():
-                if hasattr(django_model, 'primary_identifier_name') and \
-                        not issubclass(django_model, GuidMixin) and \
-                        django_model is not NotificationSubscription:
-                    if not options['nodelogs']:
-                        make_guids(django_model, page_size=django_model.migration_page_size)
-                if not options['nodelogsguids']:
-                    save_bare_models(modm_queryset, django_model, page_size=django_model.migration_page_size)
-            modm_model._cache.clear()
-            modm_model._object_cache.clear()
-            print('Took out {} trashes'.format(gc.collect()))
+        models = [django_model for django_model in models if should_migrate(django_model, options)]
+        metrics = MigrationMetrics(options['metrics_file'])
+
+        if options['defer_indexes']:
+            # make_guids writes to the guid table for every model
+            indexes = deferred_indexes(models + [Guid], state_file=options['index_state_file'])
+            indexes.drop()
+
+        try:
+            if options['workers'] > 1:
+                # guids have to exist before anything else can be migrated
+                if Guid in models:
+                    models.remove(Guid)
+                    with ipdb.launch_ipdb_on_exception():
+                        migrate_model(Guid, options, metrics)
+                migrate_models_in_parallel(models, options, options['workers'], metrics)
+            else:
+                for django_model in models:
+                    with ipdb.launch_ipdb_on_exception():
+                        migrate_model(django_model, options, metrics)
+        finally:
+            if options['defer_indexes']:
+                indexes.restore()
 
         # Handle system tags, they're on nodes, they need a special migration
         if not options['nodelogs'] and not options['nodelogsguids']:
-            save_bare_system_tags()
+            save_bare_system_tags(resume=options['resume'])
+
+        metrics.summary()
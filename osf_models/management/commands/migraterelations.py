@@ -1,11 +1,15 @@
 import gc
 import importlib
+import os
 import sys
+import tempfile
 
 import ipdb
 from django.apps import apps
 from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.core.management import BaseCommand
+from django.db import connection
 from django.db import transaction
 from django.utils import timezone
 from osf_models import models
@@ -13,42 +17,53 @@ from osf_models.models import ApiOAuth2Scope
 from osf_models.models import BlackListGuid
 from osf_models.models import CitationStyle
 from osf_models.models import Guid
+from osf_models.models import MigrationCheckpoint
 from osf_models.models import NotificationSubscription
 from osf_models.models import RecentlyAddedContributor
 from osf_models.models import Tag
 from osf_models.models.contributor import InstitutionalContributor, Contributor, AbstractBaseContributor
+from osf_models.models.contributor import EffectivePermission
+from osf_models.utils.deferred_indexes import deferred_indexes
+from osf_models.utils.deferred_triggers import deferred_node_triggers
+from osf_models.utils.lookup_table import LookupTable
 from osf_models.utils.order_apps import get_ordered_models
 
 
-def build_toku_django_lookup_table_cache():
+def build_toku_django_lookup_table_cache(path):
     models = get_ordered_models()
     # ignored models
     models.pop(models.index(Guid))
     models.pop(models.index(BlackListGuid))
+    models.pop(models.index(MigrationCheckpoint))
     models.pop(models.index(RecentlyAddedContributor))
     models.pop(models.index(Contributor))
     models.pop(models.index(InstitutionalContributor))
+    models.pop(models.index(EffectivePermission))
 
     # "special" models
     models.pop(models.index(Tag))
     models.pop(models.index(CitationStyle))
     models.pop(models.index(NotificationSubscription))
 
-    lookups = {}
-    for model in models:
-        lookup_string = 'guid__{}'.format(model.primary_identifier_name)
-        lookup_dict = {x[lookup_string]: x['pk'] for x in model.objects.all().values(lookup_string, 'pk')}
-        print('Got {} guids for {}'.format(len(lookup_dict), model._meta.model.__name__))
-        lookups.update(lookup_dict)
+    def iter_lookups():
+        for model in models:
+            lookup_string = 'guid__{}'.format(model.primary_identifier_name)
+            for item in model.objects.all().values_list(lookup_string, 'pk').iterator():
+                yield item
+            print('Got {} guids for {}'.format(model.objects.count(), model._meta.model.__name__))
 
-    # add the "special" ones
-    lookups.update(
-        {u'{}:not_system'.format(x['name']): x['pk'] for x in Tag.objects.filter(system=False).values('name', 'pk')})
-    lookups.update(
-        {u'{}:system'.format(x['name']): x['pk'] for x in Tag.objects.filter(system=True).values('name', 'pk')})
-    lookups.update({x['_id']: x['pk'] for x in CitationStyle.objects.all().values('_id', 'pk')})
-    lookups.update({x['_id']: x['pk'] for x in NotificationSubscription.objects.all().values('_id', 'pk')})
-    return lookups
+        # add the "special" ones
+        for name, pk in Tag.objects.filter(system=False).values_list('name', 'pk').iterator():
+            yield u'{}:not_system'.format(name), pk
+        for name, pk in Tag.objects.filter(system=True).values_list('name', 'pk').iterator():
+            yield u'{}:system'.format(name), pk
+        for item in CitationStyle.objects.all().values_list('_id', 'pk').iterator():
+            yield item
+        for item in NotificationSubscription.objects.all().values_list('_id', 'pk').iterator():
+            yield item
+
+    # Built in one go so that the file only shows up at path once it's complete
+    return LookupTable.build(path, iter_lookups())
 
 
 def fix_bad_data(django_obj):
@@ -81,34 +96,161 @@ def fix_bad_data(django_obj):
     return django_obj
 
 
-class Command(BaseCommand):
-    help = 'Migrations FK and M2M relationships from tokumx to postgres'
-    modm_to_django = None
+def fix_bad_data_in_bulk(django_model):
+    """
+    Set-based version of fix_bad_data, for when FKs are saved in bulk and
+    objects are never loaded.
+    :param django_model:
+    :return:
+    """
+    fixed = 0
+    if issubclass(django_model, models.Node):
+        fixed += django_model.objects.filter(title__regex=r'^\s*$').update(title='Blank Title')
 
-    def handle(self, *args, **options):
-        models = get_ordered_models()
-        self.modm_to_django = build_toku_django_lookup_table_cache()
+    if issubclass(django_model, models.Embargo):
+        fixed += django_model.objects.filter(state='active').update(state='completed')
+        fixed += django_model.objects.filter(state='cancelled').update(state='rejected')
 
-        for django_model in models:
+    if issubclass(django_model, models.Retraction):
+        fixed += django_model.objects.filter(state='cancelled').update(state='rejected')
+        # TODO: See fix_bad_data, these are guesses.
+        fixed += django_model.objects.filter(state='retracted').update(state='completed')
+        fixed += django_model.objects.filter(state='pending').update(state='unapproved')
+    if fixed:
+        print('Fixed {} bad {}s'.format(fixed, django_model._meta.model.__name__))
+    return fixed
 
-            if issubclass(django_model, AbstractBaseContributor) \
-                    or django_model is ApiOAuth2Scope \
-                    or not hasattr(django_model, 'modm_model_path'):
-                continue
 
-            module_path, model_name = django_model.modm_model_path.rsplit('.', 1)
-            modm_module = importlib.import_module(module_path)
-            modm_model = getattr(modm_module, model_name)
-            modm_queryset = modm_model.find(django_model.modm_query)
+def bulk_update_column(django_model, field, rows):
+    """
+    Set field's column for many rows with a single UPDATE ... FROM (VALUES ...).
+    :param django_model:
+    :param field: concrete field whose column is being set
+    :param rows: list of (pk, value) tuples, both integers
+    :return: number of rows updated
+    """
+    if not rows:
+        return 0
+    quote_name = connection.ops.quote_name
+    sql = (
+        'UPDATE {table} SET {column} = v.value '
+        'FROM (VALUES {values}) AS v (pk, value) '
+        'WHERE {table}.{pk_column} = v.pk'
+    ).format(
+        table=quote_name(django_model._meta.db_table),
+        column=quote_name(field.column),
+        values=', '.join(['(%s, %s)'] * len(rows)),
+        pk_column=quote_name(django_model._meta.pk.column),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [param for row in rows for param in row])
+        return cursor.rowcount
+
+
+def bulk_insert_through_rows(field, rows, batch_size=10000):
+    """
+    Insert (pk, related pk) rows into the auto-created through table of a ManyToManyField.
+    Rows that already exist, e.g. from a previous run, are skipped.
+    :param field: ManyToManyField
+    :param rows: iterable of (pk, related pk) tuples
+    :param batch_size: rows per INSERT
+    :return: number of rows inserted
+    """
+    through = field.rel.through
+    quote_name = connection.ops.quote_name
+    rows = list(rows)
+    inserted = 0
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        sql = 'INSERT INTO {table} ({source}, {target}) VALUES {values} ON CONFLICT DO NOTHING'.format(
+            table=quote_name(through._meta.db_table),
+            source=quote_name(through._meta.get_field(field.m2m_field_name()).column),
+            target=quote_name(through._meta.get_field(field.m2m_reverse_field_name()).column),
+            values=', '.join(['(%s, %s)'] * len(batch)),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [param for row in batch for param in row])
+            inserted += cursor.rowcount
+    return inserted
+
 
-            page_size = django_model.migration_page_size
+class Command(BaseCommand):
+    help = 'Migrations FK and M2M relationships from tokumx to postgres'
+    modm_to_django = None
 
-            with ipdb.launch_ipdb_on_exception():
-                self.save_fk_relationships(modm_queryset, django_model, page_size)
-                # self.save_m2m_relationships(modm_queryset, django_model, page_size)
+    def add_arguments(self, parser):
+        parser.add_argument('--resume', action='store_true',
+                            help='Skip finished models and continue partial ones from their last checkpoint')
+        parser.add_argument('--lookup-file',
+                            help='Where to keep the modm _id to django pk lookups. Reused if it already exists, '
+                                 'otherwise built there and kept for later runs.')
+        parser.add_argument('--batch', action='store_true',
+                            help='Save FKs with one UPDATE per FK column per page instead of saving each object')
+        parser.add_argument('--defer-indexes', action='store_true',
+                            help='Drop non-unique indexes and FK constraints while loading and rebuild them after')
+        parser.add_argument('--index-state-file', default='deferred_indexes.json',
+                            help='Where --defer-indexes saves what it dropped until it is rebuilt. Anything '
+                                 'listed there by a run that died is rebuilt by the next one.')
 
+    def handle(self, *args, **options):
+        models = get_ordered_models()
 
-    def save_fk_relationships(self, modm_queryset, django_model, page_size):
+        lookup_file = options['lookup_file']
+        if lookup_file and os.path.exists(lookup_file):
+            print('Using existing lookups in {}'.format(lookup_file))
+            self.modm_to_django = LookupTable(lookup_file)
+        elif lookup_file:
+            self.modm_to_django = build_toku_django_lookup_table_cache(lookup_file)
+        else:
+            fd, lookup_file = tempfile.mkstemp(suffix='.sqlite3')
+            os.close(fd)
+            self.modm_to_django = build_toku_django_lookup_table_cache(lookup_file)
+
+        if options['defer_indexes']:
+            indexes = deferred_indexes(models, state_file=options['index_state_file'])
+            indexes.drop()
+        # Setting parent_node row by row would rewrite every descendant's path each time
+        triggers = deferred_node_triggers()
+        disabled_triggers = triggers.get_disabled()
+        if disabled_triggers:
+            print('Triggers {} were left disabled by a run that was interrupted, they will be rebuilt '
+                  'and enabled when this one finishes'.format(', '.join(disabled_triggers)))
+        triggers.disable()
+
+        try:
+            for django_model in models:
+
+                if issubclass(django_model, AbstractBaseContributor) \
+                        or django_model is ApiOAuth2Scope \
+                        or not hasattr(django_model, 'modm_model_path'):
+                    continue
+
+                module_path, model_name = django_model.modm_model_path.rsplit('.', 1)
+                modm_module = importlib.import_module(module_path)
+                modm_model = getattr(modm_module, model_name)
+                modm_queryset = modm_model.find(django_model.modm_query)
+
+                page_size = django_model.migration_page_size
+
+                with ipdb.launch_ipdb_on_exception():
+                    if options['batch']:
+                        self.save_fk_relationships_in_bulk(modm_queryset, django_model, page_size, resume=options['resume'])
+                    else:
+                        self.save_fk_relationships(modm_queryset, django_model, page_size, resume=options['resume'])
+                    self.save_m2m_relationships(modm_queryset, django_model, page_size, resume=options['resume'])
+        finally:
+            try:
+                if options['defer_indexes']:
+                    indexes.restore()
+            finally:
+                # After the indexes, which the rebuild uses, but even if rebuilding those failed
+                triggers.restore()
+
+        if not options['lookup_file']:
+            os.remove(lookup_file)
+
+
+    def save_fk_relationships(self, modm_queryset, django_model, page_size, resume=False):
         print('Starting {} on {}...'.format(sys._getframe().f_code.co_name, django_model._meta.model.__name__))
 
         # TODO: Collections is getting user_id added to the bad fields. It shouldn't be.
@@ -120,12 +262,23 @@ class Command(BaseCommand):
         if len(fk_relations) == 0:
             print('{} doesn\'t have foreign keys.'.format(django_model._meta.model.__name__))
             return
+
+        checkpoint = MigrationCheckpoint.start(django_model, MigrationCheckpoint.FOREIGN_KEYS, resume=resume)
+        if checkpoint.finished:
+            print('Already finished {} on {}, skipping...'.format(sys._getframe().f_code.co_name,
+                                                                   django_model._meta.model.__name__))
+            return
+
         fk_count = 0
-        model_count = 0
+        model_count = checkpoint.object_count
         model_total = modm_queryset.count()
         bad_fields = []
+        if model_count:
+            print('Resuming {} from {} after {} objects...'.format(django_model._meta.model.__name__,
+                                                                  checkpoint.last_id, model_count))
         while model_count < model_total:
             with transaction.atomic():
+                page_start = model_count
                 for modm_obj in modm_queryset.sort('_id')[model_count:model_count + page_size]:
                     django_obj = django_model.objects.get(pk=self.modm_to_django[modm_obj._id])
                     for field in fk_relations:
@@ -168,6 +321,7 @@ class Command(BaseCommand):
                     django_obj = fix_bad_data(django_obj)
 
                     django_obj.save()
+                    last_id = modm_obj._id
                     model_count += 1
                     if model_count % page_size == 0 or model_count == model_total:
                         print('Through {} {}s and {} FKs...'.format(model_count, django_model._meta.model.__name__, fk_count))
@@ -175,56 +329,183 @@ class Command(BaseCommand):
                         modm_queryset[0]._object_cache.clear()
                         print('Took out {} trashes'.format(gc.collect()))
 
+                if model_count == page_start:
+                    # objects were removed since we counted them
+                    break
+                checkpoint.advance(last_id, model_count - page_start)
+
                 modm_queryset[0]._cache.clear()
                 modm_queryset[0]._object_cache.clear()
                 print('Took out {} trashes'.format(gc.collect()))
+        checkpoint.finish()
 
 
-    def save_m2m_relationships(self, modm_queryset, django_model, page_size):
+    def save_fk_relationships_in_bulk(self, modm_queryset, django_model, page_size, resume=False):
         print('Starting {} on {}...'.format(sys._getframe().f_code.co_name, django_model._meta.model.__name__))
-        m2m_relations = [(field.attname, field.related_model) for field in django_model._meta.get_fields() if
-                        field.is_relation and not field.auto_created and field.many_to_many]
+
+        fk_relations = [field for field in django_model._meta.get_fields() if
+                        field.is_relation and not field.auto_created and field.many_to_one]
+
+        if len(fk_relations) == 0:
+            print('{} doesn\'t have foreign keys.'.format(django_model._meta.model.__name__))
+            return
+
+        checkpoint = MigrationCheckpoint.start(django_model, MigrationCheckpoint.FOREIGN_KEYS, resume=resume)
+        if checkpoint.finished:
+            print('Already finished {} on {}, skipping...'.format(sys._getframe().f_code.co_name,
+                                                                   django_model._meta.model.__name__))
+            return
+
+        fix_bad_data_in_bulk(django_model)
+
+        fk_count = 0
+        model_count = checkpoint.object_count
+        model_total = modm_queryset.count()
+        bad_fields = []
+        if model_count:
+            print('Resuming {} from {} after {} objects...'.format(django_model._meta.model.__name__,
+                                                                  checkpoint.last_id, model_count))
+        while model_count < model_total:
+            page_finish_time = timezone.now()
+            with transaction.atomic():
+                page_start = model_count
+                # concrete field -> [(pk, value), ...]
+                updates = {}
+                for modm_obj in modm_queryset.sort('_id')[model_count:model_count + page_size]:
+                    pk = self.modm_to_django[modm_obj._id]
+                    for field in fk_relations:
+                        if isinstance(field, GenericForeignKey):
+                            value = getattr(modm_obj, field.name)
+                            if value is None:
+                                continue
+                            if value.__class__.__name__ == 'Node':
+                                gfk_model = apps.get_model('osf_models', 'AbstractNode')
+                            else:
+                                gfk_model = apps.get_model('osf_models', value.__class__.__name__)
+                            content_type = ContentType.objects.get_for_model(gfk_model)
+                            updates.setdefault(django_model._meta.get_field(field.ct_field), []).append(
+                                (pk, content_type.pk))
+                            updates.setdefault(django_model._meta.get_field(field.fk_field), []).append(
+                                (pk, self.modm_to_django[value._id]))
+                        else:
+                            field_name = field.attname
+                            if field_name in bad_fields:
+                                continue
+                            try:
+                                value = getattr(modm_obj, field_name.replace('_id', ''))
+                            except AttributeError:
+                                print('Couldn\'t find {} adding to bad_fields'.format(field_name))
+                                bad_fields.append(field_name)
+                                value = None
+                            if value is None:
+                                continue
+
+                            if isinstance(value, basestring):
+                                # it's guid as a string
+                                updates.setdefault(field, []).append((pk, self.modm_to_django[value]))
+                            else:
+                                # let's just assume it's a modm model instance
+                                updates.setdefault(field, []).append((pk, self.modm_to_django[value._id]))
+                        fk_count += 1
+                    last_id = modm_obj._id
+                    model_count += 1
+
+                if model_count == page_start:
+                    # objects were removed since we counted them
+                    break
+
+                for field, rows in updates.items():
+                    bulk_update_column(django_model, field, rows)
+                checkpoint.advance(last_id, model_count - page_start)
+
+            print('Through {} {}s and {} FKs in {} seconds...'.format(
+                model_count, django_model._meta.model.__name__, fk_count,
+                (timezone.now() - page_finish_time).total_seconds()))
+            modm_queryset[0]._cache.clear()
+            modm_queryset[0]._object_cache.clear()
+            print('Took out {} trashes'.format(gc.collect()))
+        checkpoint.finish()
+
+    def get_m2m_keys(self, modm_obj, field_name, related_model):
+        """
+        Get the lookup keys of everything modm_obj relates to through field_name.
+        :param modm_obj:
+        :param field_name:
+        :param related_model:
+        :return: list of keys into self.modm_to_django
+        """
+        keys = []
+        for item in getattr(modm_obj, field_name) or []:
+            value = item if isinstance(item, basestring) else item._id
+            if related_model is Tag:
+                keys.append(u'{}:not_system'.format(value))
+            else:
+                keys.append(value)
+        if related_model is Tag and field_name == 'tags':
+            # system tags are a list of names on the modm object but share the tags relation in django
+            for system_tag in getattr(modm_obj, 'system_tags', None) or []:
+                keys.append(u'{}:system'.format(system_tag))
+        return keys
+
+    def save_m2m_relationships(self, modm_queryset, django_model, page_size, resume=False):
+        print('Starting {} on {}...'.format(sys._getframe().f_code.co_name, django_model._meta.model.__name__))
+        start = timezone.now()
+        # M2Ms with an explicit through model (e.g. contributors) need their own migrations
+        m2m_relations = [field for field in django_model._meta.get_fields() if
+                         field.is_relation and not field.auto_created and field.many_to_many and
+                         field.rel.through._meta.auto_created]
 
         if len(m2m_relations) == 0:
             print('{} doesn\'t have any many to many relationships.'.format(django_model._meta.model.__name__))
             return
+
+        checkpoint = MigrationCheckpoint.start(django_model, MigrationCheckpoint.MANY_TO_MANY, resume=resume)
+        if checkpoint.finished:
+            print('Already finished {} on {}, skipping...'.format(sys._getframe().f_code.co_name,
+                                                                   django_model._meta.model.__name__))
+            return
+
         m2m_count = 0
-        model_count = 0
+        model_count = checkpoint.object_count
         model_total = modm_queryset.count()
+        bad_fields = []
+        if model_count:
+            print('Resuming {} from {} after {} objects...'.format(django_model._meta.model.__name__,
+                                                                  checkpoint.last_id, model_count))
         while model_count < model_total:
             with transaction.atomic():
-                for modm_obj in modm_queryset.sort('-_id')[model_count:model_count + page_size]:
-                    django_obj = django_model.objects.get(pk=self.modm_to_django[modm_obj._id])
-                    for field_name, model in m2m_relations:
-                        django_pks = []
-
-                        try:
-                            attr = getattr(django_obj, field_name)
-                        except AttributeError:
-                            print('DJANGO: {} doesn\'t have a {} attribute.'.format(django_model._meta.model.__name__, field_name))
-                            ipdb.set_trace()
-
+                page_start = model_count
+                # field -> set of (pk, related pk)
+                through_rows = {field: set() for field in m2m_relations}
+                for modm_obj in modm_queryset.sort('_id')[model_count:model_count + page_size]:
+                    pk = self.modm_to_django[modm_obj._id]
+                    for field in m2m_relations:
+                        if field.attname in bad_fields:
+                            continue
                         try:
-                            value = getattr(modm_obj, field_name, [])
+                            keys = self.get_m2m_keys(modm_obj, field.attname, field.related_model)
                         except AttributeError:
-                            print('MODM: {} doesn\'t have a {} attribute.'.format(django_model._meta.model.__name__, field_name))
-                            ipdb.set_trace()
-                        else:
-                            for item in value:
-                                if isinstance(item, basestring):
-                                    django_pks.append(self.modm_to_django[item])
-                                elif type(item) == type:
-                                    if hasattr(item, '_id'):
-                                        str_value = item._id
-                                    else:
-                                        # wth is it
-                                        ipdb.set_trace()
-                                    django_pks.append(self.modm_to_django[str_value])
-                        if len(django_pks) > 0:
-                            attr.add(*django_pks)
-                        m2m_count += len(django_pks)
+                            print('MODM: {} doesn\'t have a {} attribute, adding to bad_fields'.format(
+                                django_model._meta.model.__name__, field.attname))
+                            bad_fields.append(field.attname)
+                            continue
+                        through_rows[field].update((pk, self.modm_to_django[key]) for key in keys)
+                    last_id = modm_obj._id
                     model_count += 1
-                    if model_count % page_size == 0 or model_count == model_total:
-                        print('Through {} {}s and {} m2m'.format(model_count, django_model._meta.model.__name__, m2m_count))
-        print('Done with {} in {} seconds...'.format(sys._getframe().f_code.co_name, (timezone.now())))
 
+                if model_count == page_start:
+                    # objects were removed since we counted them
+                    break
+
+                for field, rows in through_rows.items():
+                    m2m_count += bulk_insert_through_rows(field, rows)
+                checkpoint.advance(last_id, model_count - page_start)
+
+            print('Through {} {}s and {} m2m'.format(model_count, django_model._meta.model.__name__, m2m_count))
+            modm_queryset[0]._cache.clear()
+            modm_queryset[0]._object_cache.clear()
+            print('Took out {} trashes'.format(gc.collect()))
+        checkpoint.finish()
+        print('Done with {} on {} in {} seconds...'.format(sys._getframe().f_code.co_name,
+                                                            django_model._meta.model.__name__,
+                                                            (timezone.now() - start).total_seconds()))
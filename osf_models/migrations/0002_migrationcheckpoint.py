@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osf_models', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MigrationCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=255)),
+                ('phase', models.CharField(choices=[('guids', 'Guids'), ('bare_models', 'Bare models'), ('system_tags', 'System tags'), ('foreign_keys', 'Foreign keys')], max_length=255)),
+                ('last_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('page_count', models.PositiveIntegerField(default=0)),
+                ('object_count', models.PositiveIntegerField(default=0)),
+                ('finished', models.BooleanField(default=False)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='migrationcheckpoint',
+            unique_together=set([('model', 'phase')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osf_models', '0002_migrationcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='migrationcheckpoint',
+            name='phase',
+            field=models.CharField(choices=[('guids', 'Guids'), ('bare_models', 'Bare models'), ('system_tags', 'System tags'), ('foreign_keys', 'Foreign keys'), ('many_to_many', 'Many to many')], max_length=255),
+        ),
+    ]
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+# Fill in ancestor_ids for the nodes that already exist
+POPULATE_ANCESTOR_IDS = """
+WITH RECURSIVE paths AS (
+    SELECT id, ARRAY[]::integer[] AS ancestor_ids
+    FROM osf_models_abstractnode
+    WHERE parent_node_id IS NULL
+    UNION ALL
+    SELECT child.id, paths.ancestor_ids || paths.id
+    FROM osf_models_abstractnode child
+    JOIN paths ON child.parent_node_id = paths.id
+)
+UPDATE osf_models_abstractnode
+SET ancestor_ids = paths.ancestor_ids
+FROM paths
+WHERE osf_models_abstractnode.id = paths.id;
+"""
+
+# ancestor_ids is kept up to date by triggers rather than in AbstractNode.save, since
+# parent_node is also changed with QuerySet.update, e.g. by node.nodes.add(child)
+CREATE_TRIGGERS = """
+CREATE INDEX osf_models_abstractnode_ancestor_ids_gin
+ON osf_models_abstractnode USING gin (ancestor_ids);
+
+CREATE FUNCTION osf_models_abstractnode_set_ancestor_ids() RETURNS trigger AS $$
+BEGIN
+    IF NEW.parent_node_id IS NULL THEN
+        NEW.ancestor_ids := ARRAY[]::integer[];
+    ELSE
+        SELECT ancestor_ids || id INTO NEW.ancestor_ids
+        FROM osf_models_abstractnode
+        WHERE id = NEW.parent_node_id;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Rewrite the part of each descendant's ancestor_ids above the node that moved
+CREATE FUNCTION osf_models_abstractnode_update_descendant_ancestor_ids() RETURNS trigger AS $$
+BEGIN
+    IF NEW.ancestor_ids IS DISTINCT FROM OLD.ancestor_ids THEN
+        UPDATE osf_models_abstractnode
+        SET ancestor_ids = NEW.ancestor_ids || NEW.id
+            || ancestor_ids[array_position(ancestor_ids, NEW.id) + 1:array_length(ancestor_ids, 1)]
+        WHERE ancestor_ids @> ARRAY[NEW.id];
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER osf_models_abstractnode_set_ancestor_ids
+BEFORE INSERT OR UPDATE OF parent_node_id ON osf_models_abstractnode
+FOR EACH ROW EXECUTE PROCEDURE osf_models_abstractnode_set_ancestor_ids();
+
+CREATE TRIGGER osf_models_abstractnode_update_descendant_ancestor_ids
+AFTER UPDATE OF parent_node_id ON osf_models_abstractnode
+FOR EACH ROW EXECUTE PROCEDURE osf_models_abstractnode_update_descendant_ancestor_ids();
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER osf_models_abstractnode_update_descendant_ancestor_ids ON osf_models_abstractnode;
+DROP TRIGGER osf_models_abstractnode_set_ancestor_ids ON osf_models_abstractnode;
+DROP FUNCTION osf_models_abstractnode_update_descendant_ancestor_ids();
+DROP FUNCTION osf_models_abstractnode_set_ancestor_ids();
+DROP INDEX osf_models_abstractnode_ancestor_ids_gin;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osf_models', '0003_migrationcheckpoint_many_to_many_phase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='abstractnode',
+            name='ancestor_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, size=None),
+        ),
+        migrations.RunSQL(POPULATE_ANCESTOR_IDS, migrations.RunSQL.noop),
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+    ]
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Fill in the permissions of the contributors that already exist
+POPULATE_EFFECTIVE_PERMISSIONS = """
+INSERT INTO osf_models_effectivepermission (user_id, node_id, level, source_id)
+SELECT contributor.user_id, contributor.node_id,
+    CASE WHEN contributor.admin THEN 'admin' WHEN contributor.write THEN 'write' ELSE 'read' END,
+    contributor.node_id
+FROM osf_models_contributor contributor
+WHERE contributor.read OR contributor.write OR contributor.admin;
+
+INSERT INTO osf_models_effectivepermission (user_id, node_id, level, source_id)
+SELECT contributor.user_id, descendant.id, 'read', contributor.node_id
+FROM osf_models_contributor contributor
+JOIN osf_models_abstractnode descendant ON descendant.ancestor_ids @> ARRAY[contributor.node_id]
+WHERE contributor.admin;
+"""
+
+# effectivepermission is kept up to date by triggers rather than from python, since
+# contributors are also changed with QuerySet.update, e.g. by OSFUser.merge_user, and
+# ancestor_ids is itself maintained by triggers
+CREATE_TRIGGERS = """
+-- Rewrite the rows granted by one Contributor: on its node, and if it's an admin,
+-- read on every descendant
+CREATE FUNCTION osf_models_refresh_effective_permissions(contributor_user_id integer, contributor_node_id integer)
+RETURNS void AS $$
+BEGIN
+    DELETE FROM osf_models_effectivepermission
+    WHERE user_id = contributor_user_id AND source_id = contributor_node_id;
+
+    INSERT INTO osf_models_effectivepermission (user_id, node_id, level, source_id)
+    SELECT contributor.user_id, contributor.node_id,
+        CASE WHEN contributor.admin THEN 'admin' WHEN contributor.write THEN 'write' ELSE 'read' END,
+        contributor.node_id
+    FROM osf_models_contributor contributor
+    WHERE contributor.user_id = contributor_user_id AND contributor.node_id = contributor_node_id
+        AND (contributor.read OR contributor.write OR contributor.admin);
+
+    INSERT INTO osf_models_effectivepermission (user_id, node_id, level, source_id)
+    SELECT contributor.user_id, descendant.id, 'read', contributor.node_id
+    FROM osf_models_contributor contributor
+    JOIN osf_models_abstractnode descendant ON descendant.ancestor_ids @> ARRAY[contributor.node_id]
+    WHERE contributor.user_id = contributor_user_id AND contributor.node_id = contributor_node_id
+        AND contributor.admin;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION osf_models_contributor_update_effective_permissions() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM osf_models_refresh_effective_permissions(OLD.user_id, OLD.node_id);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM osf_models_refresh_effective_permissions(NEW.user_id, NEW.node_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Rewrite the read permissions a node inherits from admins on its ancestors. Moving a
+-- node updates the ancestor_ids of all of its descendants, so this fires for each of them
+CREATE FUNCTION osf_models_abstractnode_update_effective_permissions() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        IF NEW.ancestor_ids IS NOT DISTINCT FROM OLD.ancestor_ids THEN
+            RETURN NULL;
+        END IF;
+        DELETE FROM osf_models_effectivepermission
+        WHERE node_id = NEW.id AND source_id <> NEW.id;
+    END IF;
+
+    INSERT INTO osf_models_effectivepermission (user_id, node_id, level, source_id)
+    SELECT contributor.user_id, NEW.id, 'read', contributor.node_id
+    FROM osf_models_contributor contributor
+    WHERE contributor.node_id = ANY(NEW.ancestor_ids) AND contributor.admin;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER osf_models_contributor_update_effective_permissions
+AFTER INSERT OR DELETE OR UPDATE OF user_id, node_id, read, write, admin ON osf_models_contributor
+FOR EACH ROW EXECUTE PROCEDURE osf_models_contributor_update_effective_permissions();
+
+CREATE TRIGGER osf_models_abstractnode_update_effective_permissions
+AFTER INSERT OR UPDATE OF parent_node_id, ancestor_ids ON osf_models_abstractnode
+FOR EACH ROW EXECUTE PROCEDURE osf_models_abstractnode_update_effective_permissions();
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER osf_models_abstractnode_update_effective_permissions ON osf_models_abstractnode;
+DROP TRIGGER osf_models_contributor_update_effective_permissions ON osf_models_contributor;
+DROP FUNCTION osf_models_abstractnode_update_effective_permissions();
+DROP FUNCTION osf_models_contributor_update_effective_permissions();
+DROP FUNCTION osf_models_refresh_effective_permissions(integer, integer);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osf_models', '0004_abstractnode_ancestor_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EffectivePermission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.CharField(choices=[('read', 'read'), ('write', 'write'), ('admin', 'admin')], max_length=5)),
+                ('node', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='effective_permissions', to='osf_models.AbstractNode')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='granted_permissions', to='osf_models.AbstractNode')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='effective_permissions', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='effectivepermission',
+            unique_together=set([('user', 'node', 'source')]),
+        ),
+        migrations.RunSQL(POPULATE_EFFECTIVE_PERMISSIONS, migrations.RunSQL.noop),
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+    ]
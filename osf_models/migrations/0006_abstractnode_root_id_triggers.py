@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Fill in root_id for the nodes that already exist
+POPULATE_ROOT_IDS = """
+UPDATE osf_models_abstractnode
+SET root_id = COALESCE(ancestor_ids[1], id)
+WHERE root_id IS DISTINCT FROM COALESCE(ancestor_ids[1], id);
+"""
+
+# Keep root_id in line with ancestor_ids, including for the descendants of a node that moved
+UPDATE_TRIGGERS = """
+CREATE OR REPLACE FUNCTION osf_models_abstractnode_set_ancestor_ids() RETURNS trigger AS $$
+BEGIN
+    IF NEW.parent_node_id IS NULL THEN
+        NEW.ancestor_ids := ARRAY[]::integer[];
+    ELSE
+        SELECT ancestor_ids || id INTO NEW.ancestor_ids
+        FROM osf_models_abstractnode
+        WHERE id = NEW.parent_node_id;
+    END IF;
+    NEW.root_id := COALESCE(NEW.ancestor_ids[1], NEW.id);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION osf_models_abstractnode_update_descendant_ancestor_ids() RETURNS trigger AS $$
+BEGIN
+    IF NEW.ancestor_ids IS DISTINCT FROM OLD.ancestor_ids THEN
+        UPDATE osf_models_abstractnode
+        SET ancestor_ids = NEW.ancestor_ids || NEW.id
+            || ancestor_ids[array_position(ancestor_ids, NEW.id) + 1:array_length(ancestor_ids, 1)],
+            root_id = COALESCE(NEW.ancestor_ids[1], NEW.id)
+        WHERE ancestor_ids @> ARRAY[NEW.id];
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# As in migration 0004
+RESTORE_TRIGGERS = """
+CREATE OR REPLACE FUNCTION osf_models_abstractnode_set_ancestor_ids() RETURNS trigger AS $$
+BEGIN
+    IF NEW.parent_node_id IS NULL THEN
+        NEW.ancestor_ids := ARRAY[]::integer[];
+    ELSE
+        SELECT ancestor_ids || id INTO NEW.ancestor_ids
+        FROM osf_models_abstractnode
+        WHERE id = NEW.parent_node_id;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION osf_models_abstractnode_update_descendant_ancestor_ids() RETURNS trigger AS $$
+BEGIN
+    IF NEW.ancestor_ids IS DISTINCT FROM OLD.ancestor_ids THEN
+        UPDATE osf_models_abstractnode
+        SET ancestor_ids = NEW.ancestor_ids || NEW.id
+            || ancestor_ids[array_position(ancestor_ids, NEW.id) + 1:array_length(ancestor_ids, 1)]
+        WHERE ancestor_ids @> ARRAY[NEW.id];
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osf_models', '0005_effectivepermission'),
+    ]
+
+    operations = [
+        migrations.RunSQL(UPDATE_TRIGGERS, RESTORE_TRIGGERS),
+        migrations.RunSQL(POPULATE_ROOT_IDS, migrations.RunSQL.noop),
+    ]
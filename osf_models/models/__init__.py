@@ -1,7 +1,7 @@
 from osf_models.models.metaschema import MetaSchema  # noqa
 from osf_models.models.base import Guid, BlackListGuid  # noqa
 from osf_models.models.user import OSFUser  # noqa
-from osf_models.models.contributor import Contributor, RecentlyAddedContributor  # noqa
+from osf_models.models.contributor import Contributor, EffectivePermission, RecentlyAddedContributor  # noqa
 from osf_models.models.session import Session  # noqa
 from osf_models.models.institution import Institution  # noqa
 from osf_models.models.node import AbstractNode, Node, Collection  # noqa
@@ -24,3 +24,4 @@ from osf_models.models.wiki import NodeWikiPage  # noqa
 from osf_models.models.subject import Subject  # noqa
 from osf_models.models.preprint_provider import PreprintProvider  # noqa
 from osf_models.models.preprint import Preprint  # noqa
+from osf_models.models.migration_checkpoint import MigrationCheckpoint  # noqa
@@ -1,33 +1,110 @@
+import functools
+import itertools
 import logging
 import random
+import threading
+import time
 from datetime import datetime
 
 import modularodm.exceptions
 import pytz
 from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError
+from django.db import connection
 from django.db import models
+from django.db import transaction
+from osf_models.db.backends.postgresql.base import server_side_cursors
 from osf_models.exceptions import ValidationError
 from osf_models.modm_compat import to_django_query, Q
 from osf_models.utils.base import generate_object_id
+from osf_models.utils.load_cache import cached_load, get_load_cache
 
 ALPHABET = '23456789abcdefghjkmnpqrstuvwxyz'
+# How many guids to check for at once
+GUID_RESERVOIR_SIZE = 100
+# Seconds before unused guids are checked for again, so that a long lived process
+# doesn't hand out guids another process has taken since
+GUID_RESERVOIR_MAX_AGE = 60
 
 logger = logging.getLogger(__name__)
 
+# SystemRandom so that forked processes don't generate the same guids
+_random = random.SystemRandom()
+# guid length -> (time checked, unused guids)
+_guid_reservoirs = {}
+# Held while refilling and drawing from the reservoirs, which all threads share
+_guid_reservoirs_lock = threading.Lock()
+
+
+def _find_used_guids(candidates):
+    """Of candidates, get those that are already taken or blacklisted, in one query."""
+    sql = 'SELECT guid FROM {} WHERE guid IN %s UNION ALL SELECT guid FROM {} WHERE guid IN %s'.format(
+        connection.ops.quote_name(Guid._meta.db_table),
+        connection.ops.quote_name(BlackListGuid._meta.db_table),
+    )
+    candidates = tuple(candidates)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [candidates, candidates])
+        return set(row[0] for row in cursor.fetchall())
+
+
+def generate_guids(n, length=5):
+    """Get n guids that aren't in use or blacklisted. Guids are checked for in batches
+    and kept in a per-process reservoir for up to GUID_RESERVOIR_MAX_AGE seconds, so most
+    calls don't touch the database. The unique index on Guid.guid still catches one
+    being taken by another process in the meantime.
+    """
+    with _guid_reservoirs_lock:
+        checked_at, reservoir = _guid_reservoirs.get(length, (None, None))
+        if reservoir is None or time.time() - checked_at > GUID_RESERVOIR_MAX_AGE:
+            checked_at, reservoir = time.time(), []
+            _guid_reservoirs[length] = (checked_at, reservoir)
+        while len(reservoir) < n:
+            candidates = set(''.join(_random.sample(ALPHABET, length))
+                             for _ in range(max(GUID_RESERVOIR_SIZE, n - len(reservoir))))
+            candidates.difference_update(reservoir)
+            if candidates:
+                reservoir.extend(candidates - _find_used_guids(candidates))
+        return [reservoir.pop() for _ in range(n)]
+
+
 def generate_guid(length=5):
-    while True:
-        guid_id = ''.join(random.sample(ALPHABET, length))
+    """Get a guid that isn't in use or blacklisted."""
+    return generate_guids(1, length=length)[0]
 
-        try:
-            # is the guid in the blacklist
-            BlackListGuid.objects.get(guid=guid_id)
-        except BlackListGuid.DoesNotExist:
-            # it's not, check and see if it's already in the database
-            try:
-                Guid.objects.get(guid=guid_id)
-            except Guid.DoesNotExist:
-                # valid and unique guid
-                return guid_id
+
+# TODO DELETE ME POST MIGRATION
+# (django model, modm model, excluded field names) -> names of the fields to copy
+_migration_field_plans = {}
+
+
+def get_migration_field_plan(django_model, modm_obj, exclude=()):
+    """Get the names of the local, non-relational fields of django_model that are also
+    stored on modm_obj's model. Computed once per pair of models, since every object of
+    a modm model stores the same fields.
+    """
+    key = (django_model, modm_obj.__class__, tuple(exclude))
+    plan = _migration_field_plans.get(key)
+    if plan is None:
+        local_django_fields = set([x.name for x in django_model._meta.get_fields()
+                                   if not x.is_relation and x.name not in exclude])
+        plan = tuple(local_django_fields.intersection(modm_obj.to_storage().keys()))
+        _migration_field_plans[key] = plan
+    return plan
+
+
+def copy_modm_fields(django_obj, modm_obj, exclude=()):
+    """Copy the values of the fields django_obj and modm_obj have in common, skipping Nones
+    and making datetimes UTC aware.
+    """
+    for field in get_migration_field_plan(django_obj.__class__, modm_obj, exclude=exclude):
+        modm_value = getattr(modm_obj, field)
+        if modm_value is None:
+            continue
+        if isinstance(modm_value, datetime):
+            modm_value = pytz.utc.localize(modm_value)
+        setattr(django_obj, field, modm_value)
+# /TODO DELETE ME POST MIGRATION
 
 
 class MODMCompatibilityQuerySet(models.QuerySet):
@@ -49,6 +126,35 @@ class MODMCompatibilityQuerySet(models.QuerySet):
     def limit(self, n):
         return self[:n]
 
+    def stream(self, itersize=2000):
+        """Iterate over the results with a server side cursor, so that only a batch of rows
+        is held in memory at a time. Runs in a transaction, which server side cursors need.
+        Rows are fetched as plain tuples, the cheapest kind of row for Django to read.
+        """
+        with transaction.atomic(using=self.db):
+            iterator = self.iterator()
+            try:
+                # The cursor is created on the first fetch and reused after that. Only
+                # that cursor is a server side one, other queries keep regular cursors
+                with server_side_cursors(self, itersize=itersize, once=True, row_factory='tuple'):
+                    first = list(itertools.islice(iterator, 1))
+                for obj in itertools.chain(first, iterator):
+                    try:
+                        yield obj
+                    except GeneratorExit:
+                        # Stopped early, commit rather than roll back whatever the caller did
+                        return
+            finally:
+                iterator.close()
+
+    def bulk_create(self, objs, batch_size=None):
+        # Like save, give objects with a guid or object_id their Guid rows first,
+        # but allocate them all at once
+        objs = list(objs)
+        if issubclass(self.model, BaseIDMixin):
+            self.model.allocate_guids(objs)
+        return super(MODMCompatibilityQuerySet, self).bulk_create(objs, batch_size=batch_size)
+
 
 class BaseModel(models.Model):
     """Base model that acts makes subclasses mostly compatible with the
@@ -63,6 +169,7 @@ class BaseModel(models.Model):
         abstract = True
 
     @classmethod
+    @cached_load
     def load(cls, data):
         try:
             if issubclass(cls, GuidMixin):
@@ -73,6 +180,43 @@ class BaseModel(models.Model):
         except cls.DoesNotExist:
             return None
 
+    @classmethod
+    def _load_many_lookup(cls):
+        """The field that load looks objects up by, as a lookup path. Override along
+        with load.
+        """
+        return 'pk'
+
+    @classmethod
+    def load_many(cls, ids, select_related=None):
+        """Like load, but for a list of ids and in one query.
+
+        :param list ids: what load takes for the model, e.g. guids, object_ids or pks
+        :param list select_related: Relations to fetch along with the objects
+        :return: list of objects in the same order as ids, with None for the ids
+            that weren't found
+        """
+        ids = list(ids)
+        lookup = cls._load_many_lookup()
+        queryset = cls.objects.filter(**{'{}__in'.format(lookup): ids})
+        relation = lookup.rpartition('__')[0]
+        if relation:
+            # Fetch what the lookup goes through, e.g. the Guid, to read the key from it
+            select_related = [relation] + list(select_related or [])
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        # Keyed by the same value load gets, so that it also hits the load cache
+        loaded = {
+            functools.reduce(getattr, lookup.split('__'), obj): obj
+            for obj in queryset
+        }
+
+        cache = get_load_cache()
+        if cache is not None:
+            for key, obj in loaded.items():
+                cache.set(cls, key, obj)
+        return [loaded.get(each) for each in ids]
+
     @classmethod
     def find_one(cls, query):
         try:
@@ -83,11 +227,17 @@ class BaseModel(models.Model):
             raise modularodm.exceptions.MultipleResultsFound(*e.args)
 
     @classmethod
-    def find(cls, query=None):
+    def find(cls, query=None, stream=False, chunk_size=2000):
+        """Find objects matching query. With ``stream=True``, returns an iterator that
+        fetches them ``chunk_size`` at a time instead of a queryset.
+        """
         if not query:
-            return cls.objects.all()
+            queryset = cls.objects.all()
         else:
-            return cls.objects.filter(to_django_query(query, model_cls=cls))
+            queryset = cls.objects.filter(to_django_query(query, model_cls=cls))
+        if stream:
+            return queryset.stream(itersize=chunk_size)
+        return queryset
 
     @classmethod
     def remove(cls, query):
@@ -142,20 +292,28 @@ class BaseModel(models.Model):
         django_obj = cls()
         django_obj.guid = guid
 
-        local_django_fields = set([x.name for x in django_obj._meta.get_fields() if not x.is_relation])
+        copy_modm_fields(django_obj, modm_obj)
 
-        intersecting_fields = set(modm_obj.to_storage().keys()).intersection(
-            set(local_django_fields))
+        return django_obj
 
-        for field in intersecting_fields:
-            modm_value = getattr(modm_obj, field)
-            if modm_value is None:
-                continue
-            if isinstance(modm_value, datetime):
-                modm_value = pytz.utc.localize(modm_value)
-            setattr(django_obj, field, modm_value)
 
-        return django_obj
+class GuidQuerySet(MODMCompatibilityQuerySet):
+
+    def with_referents(self):
+        """Join every referent table, so that Guid.referent doesn't need a query."""
+        return self.select_related(*(each.name for each in self.model.get_referent_relations()))
+
+    def resolve_many(self, guids):
+        """Get the referents of guids (strings) in one query, grouped by model.
+
+        :return: dict of model class -> list of referents
+        """
+        referents = {}
+        for guid in self.with_referents().filter(guid__in=guids):
+            referent = guid.referent
+            if referent is not None:
+                referents.setdefault(referent.__class__, []).append(referent)
+        return referents
 
 
 # TODO: Rename to Identifier?
@@ -171,6 +329,11 @@ class Guid(BaseModel):
     migration_page_size = 500000
     # /TODO DELETE ME POST MIGRATION
 
+    # reverse one-to-one relations from the models that inherit from BaseIDMixin
+    _referent_relations = None
+
+    objects = GuidQuerySet.as_manager()
+
     id = models.AutoField(primary_key=True)
     guid = models.fields.CharField(max_length=255,
                                    unique=True,
@@ -194,14 +357,45 @@ class Guid(BaseModel):
     def _id(self):
         return self.guid or self.object_id
 
+    @classmethod
+    def allocate(cls, n, kind='guid', min_length=5):
+        """Create n Guids with a new guid or object_id, depending on ``kind``, in two
+        queries: one to insert them and one to get their pks.
+
+        :param int n: Number of Guids to create
+        :param str kind: 'guid' or 'object_id'
+        :param int min_length: Length of generated guids
+        :return: list of saved Guids
+        """
+        if kind == 'guid':
+            identifiers = generate_guids(n, length=min_length)
+        elif kind == 'object_id':
+            identifiers = [generate_object_id() for _ in range(n)]
+        else:
+            raise ValueError('Unknown identifier kind: {}'.format(kind))
+        if not identifiers:
+            return []
+        # bulk_create doesn't set pks, so get the new rows back by their identifiers
+        cls.objects.bulk_create([cls(**{kind: identifier}) for identifier in identifiers])
+        guids = {
+            getattr(guid, kind): guid
+            for guid in cls.objects.filter(**{'{}__in'.format(kind): identifiers})
+        }
+        return [guids[identifier] for identifier in identifiers]
+
     # Override load in order to load by GUID
     @classmethod
+    @cached_load
     def load(cls, data):
         try:
             return cls.objects.get(guid=data)
         except cls.DoesNotExist:
             return None
 
+    @classmethod
+    def _load_many_lookup(cls):
+        return 'guid'
+
     @classmethod
     def find(cls, query, *args, **kwargs):
         # Make referent queryable
@@ -214,21 +408,37 @@ class Guid(BaseModel):
         else:
             return super(Guid, cls).find(query, *args, **kwargs)
 
+    @classmethod
+    def get_referent_relations(cls):
+        if cls._referent_relations is None:
+            cls._referent_relations = tuple(each for each in cls._meta.get_fields()
+                                            if each.one_to_one and each.name.startswith('referent'))
+        return cls._referent_relations
+
     @property
     def referent(self):
         """The model instance that this Guid refers to. May return an instance of
         any model that inherits from GuidMixin.
         """
         # Because the related_name for '_guid' is dynamic (e.g. 'referent_osfuser'),
-        # we need to check each one-to-one field
-        # until we find a match
-        referent_fields = (each for each in self._meta.get_fields()
-                           if each.one_to_one and each.name.startswith('referent'))
-        for relationship in referent_fields:
-            try:
-                return getattr(self, relationship.name)
-            except relationship.related_model.DoesNotExist:
-                continue
+        # we need to check each one-to-one field until we find a match. A referent that's
+        # already cached, e.g. by obj.guid, is used as is. Otherwise, unless they were all
+        # fetched with with_referents, get them all at once with one LEFT JOIN per field
+        relations = self.get_referent_relations()
+        for relationship in relations:
+            referent = getattr(self, relationship.get_cache_name(), None)
+            if referent is not None:
+                return referent
+        if self.pk and not all(hasattr(self, each.get_cache_name()) for each in relations):
+            fetched = Guid.objects.with_referents().get(pk=self.pk)
+            for relationship in relations:
+                if not hasattr(self, relationship.get_cache_name()):
+                    setattr(self, relationship.get_cache_name(),
+                            getattr(fetched, relationship.get_cache_name(), None))
+        for relationship in relations:
+            referent = getattr(self, relationship.get_cache_name(), None)
+            if referent is not None:
+                return referent
         return None
 
     @referent.setter
@@ -312,6 +522,7 @@ class BaseIDMixin(models.Model):
     _primary_key = _id
 
     @classmethod
+    @cached_load
     def load(cls, q):
         # modm doesn't throw exceptions when loading things that don't exist
         kwargs = {'guid__{}'.format(cls.primary_identifier_name): q}
@@ -320,14 +531,40 @@ class BaseIDMixin(models.Model):
         except cls.DoesNotExist:
             return None
 
+    @classmethod
+    def _load_many_lookup(cls):
+        return 'guid__{}'.format(cls.primary_identifier_name)
+
     def clone(self):
         ret = super(BaseIDMixin, self).clone()
         ret.guid = None
         return ret
 
+    @classmethod
+    def allocate_guids(cls, objs):
+        """Give each of objs that doesn't have a Guid yet a new one, allocated in bulk.
+        Used by ``bulk_create``, which doesn't call save.
+        """
+        objs = [obj for obj in objs if obj.guid_id is None]
+        guids = Guid.allocate(len(objs), kind=cls.primary_identifier_name, min_length=cls.__guid_min_length__)
+        for obj, guid in zip(objs, guids):
+            obj.guid = guid
+
+    def _create_guid(self):
+        # Initialize before saving so the Guid is inserted with its identifier
+        guid = Guid()
+        getattr(guid, 'initialize_{}'.format(self.primary_identifier_name))(self)
+        guid.save()
+        return guid
+
     def save(self, *args, **kwargs):
         if not self.guid:
-            self.guid = Guid.objects.create()
+            try:
+                with transaction.atomic():
+                    self.guid = self._create_guid()
+            except IntegrityError:
+                # Another process took the guid since it was checked for, try a fresh one
+                self.guid = self._create_guid()
         if not getattr(self.guid, self.primary_identifier_name, None):
             initialization_method = getattr(self.guid, 'initialize_{}'.format(self.primary_identifier_name))
             initialization_method(self)
@@ -350,18 +587,7 @@ class BaseIDMixin(models.Model):
         django_obj = cls()
         django_obj.guid = guid
 
-        local_django_fields = set([x.name for x in django_obj._meta.get_fields() if not x.is_relation])
-
-        intersecting_fields = set(modm_obj.to_storage().keys()).intersection(
-            set(local_django_fields))
-
-        for field in intersecting_fields:
-            modm_value = getattr(modm_obj, field)
-            if modm_value is None:
-                continue
-            if isinstance(modm_value, datetime):
-                modm_value = pytz.utc.localize(modm_value)
-            setattr(django_obj, field, modm_value)
+        copy_modm_fields(django_obj, modm_obj)
 
         return django_obj
 
@@ -32,6 +32,33 @@ class InstitutionalContributor(AbstractBaseContributor):
     class Meta:
         unique_together = ('user', 'institution')
 
+class EffectivePermission(models.Model):
+    """
+    The permission each user has on each node, denormalized from Contributor so that
+    "nodes a user can read" is a join. ``source`` is the node whose Contributor grants
+    it: the node itself, or an ancestor the user is an admin on, which grants read.
+
+    Rows are kept up to date by database triggers (see migration 0005), since
+    contributors and parents are also changed with QuerySet.update.
+    """
+    LEVELS = (
+        ('read', 'read'),
+        ('write', 'write'),
+        ('admin', 'admin'),
+    )
+
+    user = models.ForeignKey('OSFUser', related_name='effective_permissions')
+    node = models.ForeignKey('AbstractNode', related_name='effective_permissions')
+    level = models.CharField(max_length=5, choices=LEVELS)
+    source = models.ForeignKey('AbstractNode', related_name='granted_permissions')
+
+    def __repr__(self):
+        return ('<{self.__class__.__name__}(user={self.user_id}, node={self.node_id}, '
+                'level={self.level}, source={self.source_id})>').format(self=self)
+
+    class Meta:
+        unique_together = ('user', 'node', 'source')
+
 class RecentlyAddedContributor(models.Model):
     user = models.ForeignKey('OSFUser')  # the user who added the contributor
     contributor = models.ForeignKey('OSFUser', related_name='recently_added_by')  # the added contributor
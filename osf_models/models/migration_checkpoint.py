@@ -0,0 +1,62 @@
+from django.db import models
+
+
+# TODO DELETE ME POST MIGRATION
+class MigrationCheckpoint(models.Model):
+    """Records how far the tokumx to postgres migration has gotten for a model
+    in a given phase so that ``migratedata`` and ``migraterelations`` can resume.
+    Checkpoints are advanced in the same transaction as the page they describe.
+    """
+    GUIDS = 'guids'
+    BARE_MODELS = 'bare_models'
+    SYSTEM_TAGS = 'system_tags'
+    FOREIGN_KEYS = 'foreign_keys'
+    MANY_TO_MANY = 'many_to_many'
+    PHASES = (
+        (GUIDS, 'Guids'),
+        (BARE_MODELS, 'Bare models'),
+        (SYSTEM_TAGS, 'System tags'),
+        (FOREIGN_KEYS, 'Foreign keys'),
+        (MANY_TO_MANY, 'Many to many'),
+    )
+
+    model = models.CharField(max_length=255)
+    phase = models.CharField(max_length=255, choices=PHASES)
+    # _id of the last modm object in the last committed page
+    last_id = models.CharField(max_length=255, null=True, blank=True)
+    page_count = models.PositiveIntegerField(default=0)
+    object_count = models.PositiveIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    date_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('model', 'phase')
+
+    def __repr__(self):
+        return ('<MigrationCheckpoint({self.model}, {self.phase}, last_id={self.last_id}, '
+                'pages={self.page_count}, finished={self.finished})>').format(self=self)
+
+    @classmethod
+    def start(cls, django_model, phase, resume=False):
+        """Get the checkpoint for django_model and phase. Unless resuming, any
+        existing progress is thrown away.
+        """
+        checkpoint, created = cls.objects.get_or_create(model=django_model._meta.label, phase=phase)
+        if not resume and not created:
+            checkpoint.last_id = None
+            checkpoint.page_count = 0
+            checkpoint.object_count = 0
+            checkpoint.finished = False
+            checkpoint.save()
+        return checkpoint
+
+    def advance(self, last_id, object_count):
+        """Record a committed page that ended with last_id and held object_count objects."""
+        self.last_id = last_id
+        self.page_count += 1
+        self.object_count += object_count
+        self.save()
+
+    def finish(self):
+        self.finished = True
+        self.save()
@@ -8,9 +8,7 @@ import warnings
 
 from django.apps import apps
 from django.contrib.contenttypes.fields import GenericRelation
-from datetime import datetime
-
-import pytz
+from django.contrib.postgres.fields import ArrayField
 from dirtyfields import DirtyFieldsMixin
 from django.core.exceptions import ValidationError
 from django.db import models, transaction
@@ -21,7 +19,7 @@ from keen import scoped_keys
 from modularodm import Q as MQ
 from osf_models.apps import AppConfig as app_config
 from osf_models.models.citation import AlternativeCitation
-from osf_models.models.contributor import Contributor, RecentlyAddedContributor
+from osf_models.models.contributor import Contributor, EffectivePermission, RecentlyAddedContributor
 from osf_models.models.identifiers import Identifier
 from osf_models.models.identifiers import IdentifierMixin
 from osf_models.models.mixins import Loggable, Taggable, AddonModelMixin, NodeLinkMixin
@@ -34,6 +32,8 @@ from osf_models.modm_compat import Q
 from osf_models.utils.auth import Auth, get_user
 from osf_models.utils.base import api_v2_url
 from osf_models.utils.datetime_aware_jsonfield import DateTimeAwareJSONField
+from osf_models.utils.permission_cache import check_permission, invalidate_permissions
+from osf_models.utils.permission_resolver import PermissionResolver
 from typedmodels.models import TypedModel
 
 from framework import status
@@ -62,7 +62,7 @@ from website.util.permissions import (
     WRITE,
     ADMIN,
 )
-from .base import BaseModel, GuidMixin, Guid
+from .base import BaseModel, GuidMixin, Guid, copy_modm_fields
 
 logger = logging.getLogger(__name__)
 
@@ -156,6 +156,9 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
                                     related_name='nodes',
                                     on_delete=models.SET_NULL,
                                     null=True, blank=True)
+    # pks of this node's ancestors, root first. Kept up to date, along with root, by database
+    # triggers (see migrations 0004 and 0006), since parent_node is also changed with QuerySet.update
+    ancestor_ids = ArrayField(models.IntegerField(), default=list, blank=True)
     # permissions = Permissions are now on contributors
     piwik_site_id = models.IntegerField(null=True, blank=True)
     public_comments = models.BooleanField(default=True)
@@ -406,6 +409,13 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
             )
 
     def can_view(self, auth):
+        # Private links make the answer depend on more than the user and node
+        if auth and auth.private_key:
+            return self._can_view(auth)
+        user = auth.user if auth else None
+        return check_permission(user, self, 'view', lambda: self._can_view(auth), auth=auth)
+
+    def _can_view(self, auth):
         if auth and getattr(auth.private_link, 'anonymous', False):
             return self._id in auth.private_link.nodes
 
@@ -413,7 +423,7 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
             return False
 
         return (self.is_public or
-                (auth.user and self.has_permission(auth.user, 'read')) or
+                (auth.user and self.has_permission(auth.user, 'read', auth=auth)) or
                 auth.private_key in self.private_link_keys_active or
                 self.is_admin_parent(auth.user))
 
@@ -435,7 +445,7 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
         else:
             is_api_node = False
         return (
-            (user and self.has_permission(user, 'write')) or is_api_node
+            (user and self.has_permission(user, 'write', auth=auth)) or is_api_node
         )
 
     def get_aggregate_logs_query(self, auth):
@@ -483,15 +493,21 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
             perm.append(ADMIN)
         return perm
 
-    def has_permission(self, user, permission, check_parent=True):
+    def has_permission(self, user, permission, check_parent=True, auth=None):
         """Check whether user has permission.
 
         :param User user: User to test
         :param str permission: Required permission
+        :param Auth auth: Auth of the request, whose permission cache is used if it has one
         :returns: User has required permission
         """
         if not user:
             return False
+        key = permission if check_parent else '{}:own'.format(permission)
+        return check_permission(user, self, key, lambda: self._has_permission(user, permission, check_parent),
+                                auth=auth)
+
+    def _has_permission(self, user, permission, check_parent=True):
         try:
             contrib = user.contributor_set.get(node=self)
         except Contributor.DoesNotExist:
@@ -507,40 +523,85 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
         """Checks if the given user has a given permission on any child nodes
             that are not registrations or deleted
         """
-        if self.has_permission(user, permission):
+        resolver = PermissionResolver(user, self)
+        if resolver.has_permission(self, permission):
             return True
-        for node in self.nodes.filter(is_deleted=False):
-            if node.has_permission_on_children(user, permission):
+        children = self._get_subtree()
+        stack = [node for node in children.get(self.pk, ()) if not node.is_deleted]
+        while stack:
+            node = stack.pop()
+            if resolver.has_permission(node, permission):
                 return True
+            stack.extend(child for child in children.get(node.pk, ()) if not child.is_deleted)
         return False
 
     def is_admin_parent(self, user):
-        if self.has_permission(user, 'admin', check_parent=False):
-            return True
-        if self.parent_node:
-            return self.parent_node.is_admin_parent(user)
-        return False
+        """Whether user is an admin on this node or any of its ancestors."""
+        if not user:
+            return False
+        return Contributor.objects.filter(
+            user=user,
+            admin=True,
+            node_id__in=[self.pk] + self._ancestor_ids
+        ).exists()
 
     def find_readable_descendants(self, auth):
         """ Returns a generator of first descendant node(s) readable by <user>
         in each descendant branch.
         """
-        new_branches = []
-        for node in self.nodes.filter(is_deleted=False):
-            if node.can_view(auth):
-                yield node
-            else:
-                new_branches.append(node)
+        user = auth.user if auth else None
+        readable_ids = set()
+        if user:
+            readable_ids.update(EffectivePermission.objects.filter(
+                user=user,
+                node__ancestor_ids__contains=[self.pk]
+            ).values_list('node_id', flat=True))
+        children = self._get_subtree()
+
+        def can_view(node):
+            # Like can_view, with the user's permissions from readable_ids
+            if auth and getattr(auth.private_link, 'anonymous', False):
+                return node._id in auth.private_link.nodes
+            return (
+                node.is_public or
+                node.pk in readable_ids or
+                bool(auth and auth.private_key and auth.private_key in node.private_link_keys_active)
+            )
 
-        for bnode in new_branches:
-            for node in bnode.find_readable_descendants(auth):
-                yield node
+        def find_readable(parent_pk):
+            new_branches = []
+            for node in children.get(parent_pk, ()):
+                if node.is_deleted:
+                    continue
+                if can_view(node):
+                    yield node
+                else:
+                    new_branches.append(node)
+
+            for bnode in new_branches:
+                for node in find_readable(bnode.pk):
+                    yield node
+
+        return find_readable(self.pk)
+
+    @property
+    def _ancestor_ids(self):
+        """pks of this node's ancestors, root first. Worked out from the parent if parent_node
+        was changed since ancestor_ids was last saved.
+        """
+        ancestor_ids = list(self.ancestor_ids or [])
+        if self.parent_node_id == (ancestor_ids[-1] if ancestor_ids else None):
+            return ancestor_ids
+        if self.parent_node_id is None:
+            return []
+        return self.parent_node._ancestor_ids + [self.parent_node_id]
 
     @property
     def parents(self):
-        if self.parent_node:
-            return [self.parent_node] + self.parent_node.parents
-        return []
+        """This node's ancestors, parent first."""
+        ancestor_ids = self._ancestor_ids
+        ancestors = AbstractNode.objects.in_bulk(ancestor_ids)
+        return [ancestors[pk] for pk in reversed(ancestor_ids) if pk in ancestors]
 
     @property
     def admin_contributor_ids(self):
@@ -600,9 +661,19 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
 
     @property
     def license(self):
+        """This node's license, or the license of its closest ancestor that has one."""
         node_license = self.node_license
-        if not node_license and self.parent_node:
-            return self.parent_node.license
+        if not node_license and self.parent_node_id:
+            ancestor_ids = self._ancestor_ids
+            licensed = {
+                node.pk: node.node_license
+                for node in AbstractNode.objects.filter(
+                    pk__in=ancestor_ids, node_license__isnull=False
+                ).select_related('node_license')
+            }
+            for pk in reversed(ancestor_ids):
+                if pk in licensed:
+                    return licensed[pk]
         return node_license
 
     @property
@@ -979,17 +1050,26 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
             self.save()
 
     @classmethod
-    def find_for_user(cls, user, subquery=None):
-        combined_query = Q('contributors', 'eq', user)
-        if subquery is not None:
-            combined_query = combined_query & subquery
-        return cls.find(combined_query)
+    def find_for_user(cls, user, subquery=None, inherited=False):
+        """Nodes user is a contributor on. With ``inherited=True``, every node user can
+        read, including the descendants of nodes they are an admin on.
+        """
+        queryset = cls.find(subquery)
+        if inherited:
+            return queryset.filter(effective_permissions__user=user).distinct()
+        return queryset.filter(
+            effective_permissions__user=user,
+            effective_permissions__source=models.F('pk')
+        )
 
     def can_comment(self, auth):
+        return check_permission(auth.user, self, 'comment', lambda: self._can_comment(auth), auth=auth)
+
+    def _can_comment(self, auth):
         if self.comment_level == 'public':
             return auth.logged_in and (
                 self.is_public or
-                (auth.user and self.has_permission(auth.user, 'read'))
+                (auth.user and self.has_permission(auth.user, 'read', auth=auth))
             )
         return self.is_contributor(auth.user)
 
@@ -1074,19 +1154,17 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
 
     @property
     def _root(self):
-        if self.parent_node:
-            return self.parent_node._root
-        else:
-            return self
+        ancestor_ids = self._ancestor_ids
+        if ancestor_ids:
+            return AbstractNode.objects.get(pk=ancestor_ids[0])
+        return self
 
     def find_readable_antecedent(self, auth):
         """ Returns first antecendant node readable by <user>.
         """
-        next_parent = self.parent_node
-        while next_parent:
-            if next_parent.can_view(auth):
-                return next_parent
-            next_parent = next_parent.parent_node
+        for parent in self.parents:
+            if parent.can_view(auth):
+                return parent
 
     def copy_contributors_from(self, node):
         """Copies the contibutors from node (including permissions and visibility) into this node."""
@@ -1149,9 +1227,7 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
         # registered.save()
 
         # Clone each log from the original node for this registration.
-        logs = original.logs.all()
-        for log in logs:
-            log.clone_node_log(registered._id)
+        NodeLog.clone_node_logs(original.logs.all(), registered)
 
         registered.is_public = False
         for node in registered.get_descendants_recursive():
@@ -1219,15 +1295,30 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
             save=True,
         )
 
-    # TODO optimize me
+    def _get_subtree(self):
+        """Get a dict of parent pk -> children, in their order, for every node under this
+        one, with one query.
+        """
+        children = {}
+        for node in AbstractNode.objects.filter(ancestor_ids__contains=[self.pk]):
+            children.setdefault(node.parent_node_id, []).append(node)
+        return children
+
     def get_descendants_recursive(self, include=lambda n: True):
-        for node in self.nodes.all():
-            if include(node):
-                yield node
-            if node.primary:
-                for descendant in node.get_descendants_recursive(include):
-                    if include(descendant):
-                        yield descendant
+        """Yield the descendants of this node depth first, in the same order as recursing
+        through ``nodes`` would. The whole subtree is fetched with one indexed query.
+        """
+        children = self._get_subtree()
+        stack = [iter(children.get(self.pk, ()))]
+        while stack:
+            for node in stack[-1]:
+                if include(node):
+                    yield node
+                if node.primary:
+                    stack.append(iter(children.get(node.pk, ())))
+                    break
+            else:
+                stack.pop()
 
     @property
     def nodes_primary(self):
@@ -1361,8 +1452,7 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
         )
 
         # Clone each log from the original node for this fork.
-        for log in original.logs.all():
-            log.clone_node_log(forked._id)
+        NodeLog.clone_node_logs(original.logs.all(), forked)
 
         forked.refresh_from_db()
 
@@ -1466,15 +1556,20 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
 
         returns a list of [(node, [children]), ...]
         """
-        ret = []
-        for node in self.nodes.order_by('date_created').all():
-            if condition(auth, node):
-                # base case
-                ret.append((node, []))
-            else:
-                ret.append((node, node.next_descendants(auth, condition)))
-        ret = [item for item in ret if item[1] or condition(auth, item[0])]  # prune empty branches
-        return ret
+        children = self._get_subtree()
+
+        def next_descendants(parent_pk):
+            ret = []
+            for node in sorted(children.get(parent_pk, ()), key=lambda node: node.date_created):
+                if condition(auth, node):
+                    # base case
+                    ret.append((node, []))
+                else:
+                    ret.append((node, next_descendants(node.pk)))
+            ret = [item for item in ret if item[1] or condition(auth, item[0])]  # prune empty branches
+            return ret
+
+        return next_descendants(self.pk)
 
     def node_and_primary_descendants(self):
         """Return an iterator for a node and all of its primary (non-pointer) descendants.
@@ -1553,11 +1648,14 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
             visibility_removed = []
             to_retain = []
             to_remove = []
-            for user_dict in user_dicts:
-                user = OSFUser.load(user_dict['id'])
+            loaded_users = OSFUser.load_many([user_dict['id'] for user_dict in user_dicts])
+            contributor_ids = set(self.contributors.filter(
+                id__in=[user.id for user in loaded_users if user is not None]
+            ).values_list('id', flat=True))
+            for user_dict, user in zip(user_dicts, loaded_users):
                 if user is None:
                     raise ValueError('User not found')
-                if not self.contributors.filter(id=user.id).exists():
+                if user.id not in contributor_ids:
                     raise ValueError(
                         'User {0} not in contributors'.format(user.fullname)
                     )
@@ -1633,14 +1731,28 @@ class AbstractNode(DirtyFieldsMixin, TypedModel, AddonModelMixin, IdentifierMixi
                 project_signals.write_permissions_revoked.send(self)
 
     def save(self, *args, **kwargs):
-        if self.pk:
-            self.root = self._root
+        if getattr(self, '_parent', None):
+            self.parent_node = self._parent
+        # The database triggers have the final say, this keeps the instance in line with them
+        ancestor_ids = self._ancestor_ids
+        if self.pk and ancestor_ids != self.ancestor_ids:
+            # Moved, so permissions inherited from admin parents may have changed
+            invalidate_permissions()
+        self.ancestor_ids = ancestor_ids
+        root_id = self.ancestor_ids[0] if self.ancestor_ids else self.pk
+        if root_id and root_id != self.root_id:
+            self.root_id = root_id
+            self.__dict__.pop(AbstractNode._meta.get_field('root').get_cache_name(), None)
         if 'suppress_log' in kwargs.keys():
             self._suppress_log = kwargs['suppress_log']
             del kwargs['suppress_log']
         else:
             self._suppress_log = False
-        return super(AbstractNode, self).save(*args, **kwargs)
+        ret = super(AbstractNode, self).save(*args, **kwargs)
+        if self.root_id is None:
+            # The trigger makes new root nodes their own root
+            self.root_id = self.pk
+        return ret
 
     @classmethod
     def migrate_from_modm(cls, modm_obj):
@@ -1992,20 +2104,8 @@ class Node(AbstractNode):
         django_obj = cls()
         django_obj.guid = guid
 
-        bad_names = ['institution_logo_name']
-        local_django_fields = set(
-            [x.name for x in django_obj._meta.get_fields() if not x.is_relation and x.name not in bad_names])
-
-        intersecting_fields = set(modm_obj.to_storage().keys()).intersection(
-            set(local_django_fields))
-
-        for field in intersecting_fields:
-            modm_value = getattr(modm_obj, field)
-            if modm_value is None:
-                continue
-            if isinstance(modm_value, datetime):
-                modm_value = pytz.utc.localize(modm_value)
-            setattr(django_obj, field, modm_value)
+        bad_names = ('institution_logo_name', )
+        copy_modm_fields(django_obj, modm_obj, exclude=bad_names)
         django_obj._order = 0
         return django_obj
 
@@ -169,3 +169,21 @@ class NodeLog(ObjectIDMixin, BaseModel):
         log_clone.user = original_log.user
         log_clone.save()
         return log_clone
+
+    @classmethod
+    def clone_node_logs(cls, logs, node):
+        """
+        Like clone_node_log, but clones all of logs onto node with a single
+        bulk insert.
+
+        :param logs: NodeLogs to clone
+        :param node: The fork or registration
+        :return: cloned logs
+        """
+        clones = []
+        for log in logs:
+            log.pk = None
+            log.guid = None
+            log.node = node
+            clones.append(log)
+        return cls.objects.bulk_create(clones)
@@ -1,12 +1,10 @@
-from datetime import datetime
-
-import pytz
 from django.contrib.postgres.fields import ArrayField
 from django.db import models
 from osf_models.models import Node
 from osf_models.models import OSFUser
-from osf_models.models.base import BaseModel, ObjectIDMixin
+from osf_models.models.base import BaseModel, ObjectIDMixin, copy_modm_fields
 from osf_models.models.validators import validate_subscription_type
+from osf_models.utils.load_cache import cached_load
 from website.notifications.constants import NOTIFICATION_TYPES
 
 
@@ -30,6 +28,7 @@ class NotificationSubscription(BaseModel):
     email_transactional = models.ManyToManyField('OSFUser', related_name='+')  # are pointless
 
     @classmethod
+    @cached_load
     def load(cls, q):
         # modm doesn't throw exceptions when loading things that don't exist
         try:
@@ -37,6 +36,10 @@ class NotificationSubscription(BaseModel):
         except cls.DoesNotExist:
             return None
 
+    @classmethod
+    def _load_many_lookup(cls):
+        return '_id'
+
     @classmethod
     def migrate_from_modm(cls, modm_obj):
         """
@@ -49,18 +52,7 @@ class NotificationSubscription(BaseModel):
         django_obj = cls()
         django_obj._id = modm_obj._id
 
-        local_django_fields = set([x.name for x in django_obj._meta.get_fields() if not x.is_relation])
-
-        intersecting_fields = set(modm_obj.to_storage().keys()).intersection(
-            set(local_django_fields))
-
-        for field in intersecting_fields:
-            modm_value = getattr(modm_obj, field)
-            if modm_value is None:
-                continue
-            if isinstance(modm_value, datetime):
-                modm_value = pytz.utc.localize(modm_value)
-            setattr(django_obj, field, modm_value)
+        copy_modm_fields(django_obj, modm_obj)
 
         return django_obj
 
@@ -25,12 +25,16 @@ class PrivateLink(ObjectIDMixin, BaseModel):
         return self.nodes.filter(is_deleted=False).values_list('guid__guid', flat=True)
 
     def node_scale(self, node):
-        # node may be None if previous node's parent is deleted
-        if node is None or node.parent_id not in self.node_ids:
+        # Indent 20px for each ancestor of node, closest first, that's also in this link
+        if node is None:
             return -40
-        else:
-            offset = 20 if node.parent_node is not None else 0
-            return offset + self.node_scale(node.parent_node)
+        node_ids = set(self.nodes.filter(is_deleted=False).values_list('pk', flat=True))
+        scale = -40
+        for ancestor_id in reversed(node._ancestor_ids):
+            if ancestor_id not in node_ids:
+                break
+            scale += 20
+        return scale
 
     def to_json(self):
         return {
@@ -1,6 +1,7 @@
 from django.db import models
 
 from .base import BaseModel
+from osf_models.utils.load_cache import cached_load
 
 class Tag(BaseModel):
     # TODO DELETE ME POST MIGRATION
@@ -23,6 +24,7 @@ class Tag(BaseModel):
         return self.name.lower()
 
     @classmethod
+    @cached_load
     def load(cls, data):
         """For compatibility with v1: the tag name used to be the _id,
         so we make Tag.load('tagname') work as if `name` were the primary key.
@@ -32,6 +34,10 @@ class Tag(BaseModel):
         except cls.DoesNotExist:
             return None
 
+    @classmethod
+    def _load_many_lookup(cls):
+        return 'name'
+
     @classmethod
     def migrate_from_modm(cls, modm_obj):
         """
@@ -46,6 +46,7 @@ from osf_models.models.contributor import RecentlyAddedContributor
 from osf_models.utils import security
 from osf_models.utils.datetime_aware_jsonfield import DateTimeAwareJSONField
 from osf_models.utils.names import impute_names
+from osf_models.utils.permission_cache import invalidate_permissions
 from osf_models.modm_compat import Q
 
 logger = logging.getLogger(__name__)
@@ -630,6 +631,9 @@ class OSFUser(DirtyFieldsMixin, GuidMixin, BaseModel,
                 node.contributor_set.filter(user=user).update(user=self)
 
             node.save()
+        # Contributors were moved with QuerySet.update, which doesn't send signals
+        invalidate_permissions(user=user)
+        invalidate_permissions(user=self)
 
         # - projects where the user was the creator
         user.created.update(creator=self)
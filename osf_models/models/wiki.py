@@ -241,10 +241,12 @@ class NodeWikiPage(GuidMixin, BaseModel):
         copy.wiki_pages_versions = {}
         copy.wiki_pages_current = {}
 
+        wiki_ids = [wiki_id for key in node.wiki_pages_versions for wiki_id in node.wiki_pages_versions[key]]
+        node_wikis = dict(zip(wiki_ids, NodeWikiPage.load_many(wiki_ids)))
         for key in node.wiki_pages_versions:
             copy.wiki_pages_versions[key] = []
             for wiki_id in node.wiki_pages_versions[key]:
-                node_wiki = NodeWikiPage.load(wiki_id)
+                node_wiki = node_wikis[wiki_id]
                 cloned_wiki = node_wiki.clone_wiki(copy._id)
                 copy.wiki_pages_versions[key].append(cloned_wiki._id)
                 if node_wiki.is_current:
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from operator import and_, or_
+import itertools
 
 from django.db.models import Q as DjangoQ
 from django.db.models import FieldDoesNotExist
@@ -23,7 +23,14 @@ class CompoundQ(BaseQ, query.QueryGroup):
         return self.__queries
 
     def __init__(self, *queries):
-        self.__queries = queries
+        # Keep groups flat: AndQ(a, AndQ(b, c)) is AndQ(a, b, c)
+        nodes = []
+        for each in queries:
+            if isinstance(each, self.__class__):
+                nodes.extend(each.nodes)
+            else:
+                nodes.append(each)
+        self.__queries = tuple(nodes)
 
     def __repr__(self):
         return '<{0}({1})>'.format(
@@ -33,29 +40,20 @@ class CompoundQ(BaseQ, query.QueryGroup):
 
     @classmethod
     def from_modm_query(cls, query, model_cls=None):
-        op_function = and_ if query.operator == 'and' else or_
-        return reduce(op_function, (Q.from_modm_query(node, model_cls) for node in query.nodes))
+        compound_cls = AndQ if query.operator == 'and' else OrQ
+        return compound_cls(*(Q.from_modm_query(node, model_cls) for node in query.nodes))
+
+    def to_django_query(self):
+        return to_django_query(self)
 
 class AndQ(CompoundQ):
 
     operator = 'and'
 
-    def __and__(self, other):
-        return AndQ(other, *self.nodes)
-
-    def to_django_query(self):
-        return reduce(lambda acc, val: acc & val, (q.to_django_query() for q in self.nodes))
-
 class OrQ(CompoundQ):
 
     operator = 'or'
 
-    def __or__(self, other):
-        return OrQ(other, *self.nodes)
-
-    def to_django_query(self):
-        return reduce(lambda acc, val: acc | val, (q.to_django_query() for q in self.nodes))
-
 class Q(BaseQ, query.RawQuery):
     QUERY_MAP = {'eq': 'exact'}
 
@@ -158,7 +156,183 @@ def _get_internal_type(field):
         return None
 
 
+# Compiled queries are kept for this many (model, query shape) pairs before starting over
+COMPILED_QUERY_CACHE_SIZE = 1000
+
+# (model, query shape) -> compiled query
+_compiled_queries = {}
+
+
+def _get_argument_kind(argument):
+    # Arguments that change the lookup a query is translated to, rather than just its value
+    if argument is None:
+        return 'none'
+    if isinstance(argument, (list, tuple)) and not argument:
+        return 'empty'
+    return 'value'
+
+
+def _iter_group_nodes(group):
+    """Iterate over the nodes of group, splicing in the nodes of nested groups with the
+    same operator. Doesn't recurse, so long chains of a | b | c ... are fine.
+    """
+    stack = [iter(group.nodes)]
+    while stack:
+        for node in stack[-1]:
+            if isinstance(node, QueryGroup) and node.operator == group.operator:
+                stack.append(iter(node.nodes))
+                break
+            yield node
+        else:
+            stack.pop()
+
+
+def _get_shape(query, arguments):
+    """Get a hashable description of query that leaves out its arguments, which are
+    appended to ``arguments`` in the order they're found.
+    """
+    if isinstance(query, QueryGroup):
+        return (query.operator, tuple(_get_shape(node, arguments) for node in _iter_group_nodes(query)))
+    if isinstance(query, (MODMQ, Q)):
+        arguments.append(query.argument)
+        return (query.__class__, query.attribute, query.operator, _get_argument_kind(query.argument))
+    return (query.__class__, )
+
+
+def _compile_leaf(query, model_cls):
+    """Compile a single Q to a (lookup, negated, argument -> value, __in lookup) tuple.
+    The __in lookup is set for equality lookups that can be merged into one.
+    """
+    template = Q.from_modm_query(query, model_cls=model_cls)
+    key = '__'.join(template.key.split('.'))
+    if template.argument is None:
+        value = template.val
+        return ('{}__isnull'.format(key), False, lambda argument: value, None)
+    if template.op == 'ne':
+        return (key, True, lambda argument: argument, None)
+    lookup = '{}__{}'.format(key, template.op)
+    if template.operator != query.operator:
+        # Rewritten by from_modm_query, e.g. Q('tags', 'eq', []) -> tags__isnull=True
+        # or Q('array', 'eq', x) -> array__contains=[x]
+        if template.operator == 'contains':
+            return (lookup, False, lambda argument: [argument], None)
+        value = template.val
+        return (lookup, False, lambda argument: value, None)
+    in_lookup = '{}__in'.format(key) if template.op == 'exact' else None
+    return (lookup, False, lambda argument: argument, in_lookup)
+
+
+def _merge_equality_lookups(nodes):
+    """Merge the equality lookups on the same field of an 'or' group into __in lookups."""
+    merged = []
+    # __in lookup -> (position in merged, argument indexes)
+    groups = {}
+    for node in nodes:
+        if node[0] == 'leaf' and node[5] is not None:
+            in_lookup, indexes = node[5], (node[1], )
+        elif node[0] == 'in':
+            in_lookup, indexes = node[2], node[1]
+        else:
+            merged.append(node)
+            continue
+        group = groups.get(in_lookup)
+        if group is None:
+            groups[in_lookup] = (len(merged), list(indexes))
+            merged.append(node)
+        else:
+            group[1].extend(indexes)
+    # Build the 'in' nodes once all their indexes are known
+    for in_lookup, (position, indexes) in groups.items():
+        if len(indexes) > 1:
+            merged[position] = ('in', tuple(indexes), in_lookup)
+    return merged
+
+
+def _compile(query, model_cls, indexes):
+    """Compile query to nested tuples of:
+
+    ('leaf', argument index, lookup, negated, argument -> value, __in lookup)
+    ('in', argument indexes, lookup)
+    ('and' or 'or', nodes)
+
+    Nested groups with the same operator are flattened.
+    """
+    if isinstance(query, QueryGroup):
+        nodes = [_compile(node, model_cls, indexes) for node in _iter_group_nodes(query)]
+        if query.operator == 'or':
+            nodes = _merge_equality_lookups(nodes)
+        return (query.operator, tuple(nodes))
+    # Raises ValueError for things that aren't queries
+    return ('leaf', next(indexes)) + _compile_leaf(query, model_cls)
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return None
+    return value
+
+
+def _bind(compiled, arguments):
+    """Fill arguments into a compiled query. Returns a child for a Django Q, which is either
+    a (lookup, value) tuple or a Q, and a key for spotting duplicates, or None.
+    """
+    kind = compiled[0]
+    if kind == 'leaf':
+        lookup, negated, get_value = compiled[2:5]
+        child = (lookup, get_value(arguments[compiled[1]]))
+        if negated:
+            return ~DjangoQ(child), _hashable(('not', child))
+        return child, _hashable(child)
+    if kind == 'in':
+        values = []
+        seen = set()
+        for index in compiled[1]:
+            value = arguments[index]
+            try:
+                if value in seen:
+                    continue
+                seen.add(value)
+            except TypeError:
+                # Unhashable, e.g. a list
+                if value in values:
+                    continue
+            values.append(value)
+        return (compiled[2], values), None
+    children = []
+    seen = set()
+    for node in compiled[1]:
+        child, key = _bind(node, arguments)
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+        children.append(child)
+    if len(children) == 1:
+        return children[0], None
+    django_query = DjangoQ(*children)
+    django_query.connector = DjangoQ.AND if kind == 'and' else DjangoQ.OR
+    return django_query, None
+
+
 def to_django_query(query, model_cls=None):
     """Translate a modular-odm Q or QueryGroup to a Django query.
+
+    Translations are compiled once per model and query shape (the query without its
+    arguments) and the arguments are filled in on every call. Nested groups are
+    flattened, duplicate lookups dropped and 'eq' queries on the same field of an
+    'or' group merged into one 'in'.
     """
-    return Q.from_modm_query(query, model_cls=model_cls).to_django_query()
+    arguments = []
+    key = (model_cls, _get_shape(query, arguments))
+    compiled = _compiled_queries.get(key)
+    if compiled is None:
+        compiled = _compile(query, model_cls, itertools.count())
+        if len(_compiled_queries) >= COMPILED_QUERY_CACHE_SIZE:
+            _compiled_queries.clear()
+        _compiled_queries[key] = compiled
+    django_query, key = _bind(compiled, arguments)
+    if isinstance(django_query, tuple):
+        django_query = DjangoQ(django_query)
+    return django_query
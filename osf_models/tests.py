@@ -1,9 +1,23 @@
 import datetime as dt
+import functools
 import json
+import operator
+import os
+import shutil
+import tempfile
 from decimal import Decimal
 
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+from modularodm import Q as MQ
+from osf_models.models import Contributor, EffectivePermission, Node, OSFUser, Tag
+from osf_models.modm_compat import to_django_query
+from osf_models.utils.auth import Auth
+from osf_models.utils.bulk_writers import format_copy_value
 from osf_models.utils.datetime_aware_jsonfield import DateTimeAwareJSONEncoder, decode_datetime_objects
+from osf_models.utils.load_cache import LoadCache, cached_load, cached_loads, get_load_cache
+from osf_models.utils.lookup_table import LookupTable
+from osf_models.utils.permission_cache import PermissionCache, cached_permissions
+from osf_models.utils.permission_resolver import PermissionResolver
 
 
 class DateTimeAwareJSONFieldTests(TestCase):
@@ -66,3 +80,414 @@ class DateTimeAwareJSONFieldTests(TestCase):
         json_string = json.dumps(self.json_list_data, cls=DateTimeAwareJSONEncoder)
         json_data = decode_datetime_objects(json.loads(json_string))
         assert json_data == self.json_list_data, 'Nope'
+
+
+class FormatCopyValueTests(SimpleTestCase):
+
+    def test_null_is_unquoted(self):
+        assert format_copy_value(None) == ''
+        assert format_copy_value('') == '""'
+
+    def test_quotes_are_doubled(self):
+        assert format_copy_value('say "hi"') == '"say ""hi"""'
+
+    def test_bool(self):
+        assert format_copy_value(True) == '"t"'
+        assert format_copy_value(False) == '"f"'
+
+    def test_unicode(self):
+        assert format_copy_value(u'caf\xe9') == '"caf\xc3\xa9"'
+
+    def test_array(self):
+        assert format_copy_value(['a', None, 'b"c']) == '"{""a"",NULL,""b\\""c""}"'
+
+
+class ToDjangoQueryTests(SimpleTestCase):
+
+    def test_or_of_equalities_is_merged_into_in(self):
+        query = functools.reduce(operator.or_, [MQ('title', 'eq', str(i % 1000)) for i in range(5000)])
+        django_query = to_django_query(query)
+        assert django_query.children == [('title__in', [str(i) for i in range(1000)])]
+
+    def test_unhashable_values_are_deduplicated(self):
+        query = MQ('title', 'eq', ['a']) | MQ('title', 'eq', ['b']) | MQ('title', 'eq', ['a'])
+        assert to_django_query(query).children == [('title__in', [['a'], ['b']])]
+
+
+class LookupTableTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'lookups.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup(self):
+        table = LookupTable.build(self.path, [('abc12', 1), (u'5418a4b7f6e5c2ce0afcbe10', 2)])
+        assert table['abc12'] == 1
+        assert table['5418a4b7f6e5c2ce0afcbe10'] == 2
+        assert 'abc12' in table
+        assert len(table) == 2
+
+    def test_missing_key(self):
+        table = LookupTable.build(self.path, {'abc12': 1})
+        assert table.get('zzz99') is None
+        with self.assertRaises(KeyError):
+            table['zzz99']
+
+    def test_later_keys_replace_earlier_ones(self):
+        table = LookupTable.build(self.path, [('abc12', 1)])
+        table.update([('abc12', 3)])
+        assert table['abc12'] == 3
+
+    def test_reopen(self):
+        LookupTable.build(self.path, [('abc12', 1)])
+        assert LookupTable(self.path)['abc12'] == 1
+
+    def test_failed_build_leaves_no_file(self):
+        def items():
+            yield 'abc12', 1
+            raise RuntimeError('Interrupted')
+        with self.assertRaises(RuntimeError):
+            LookupTable.build(self.path, items())
+        assert os.listdir(self.tmpdir) == []
+
+
+class LoadCacheTests(SimpleTestCase):
+
+    class FakeModel(object):
+        class _meta(object):
+            concrete_model = None
+
+        def __init__(self, pk):
+            self.pk = pk
+
+        @classmethod
+        @cached_load
+        def load(cls, data):
+            cls.loads += 1
+            return cls(data) if data != 'missing' else None
+
+    def setUp(self):
+        self.FakeModel.loads = 0
+
+    def test_hits_and_misses(self):
+        with cached_loads() as cache:
+            first = self.FakeModel.load('abc12')
+            assert self.FakeModel.load('abc12') is first
+        assert self.FakeModel.loads == 1
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+        assert cache.hit_ratio == 0.5
+
+    def test_not_cached_outside_block(self):
+        with cached_loads():
+            self.FakeModel.load('abc12')
+        assert get_load_cache() is None
+        self.FakeModel.load('abc12')
+        assert self.FakeModel.loads == 2
+
+    def test_missing_objects_are_not_cached(self):
+        with cached_loads():
+            assert self.FakeModel.load('missing') is None
+            assert self.FakeModel.load('missing') is None
+        assert self.FakeModel.loads == 2
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LoadCache(maxsize=2)
+        cache.set(self.FakeModel, 'a', self.FakeModel('a'))
+        cache.set(self.FakeModel, 'b', self.FakeModel('b'))
+        cache.get(self.FakeModel, 'a')
+        cache.set(self.FakeModel, 'c', self.FakeModel('c'))
+        assert cache.get(self.FakeModel, 'b') is None
+        assert cache.get(self.FakeModel, 'a') is not None
+        assert len(cache) == 2
+
+    def test_invalidate(self):
+        cache = LoadCache()
+        instance = self.FakeModel(1)
+        cache.set(self.FakeModel, 'abc12', instance)
+        cache.set(self.FakeModel, 1, instance)
+        cache.invalidate(self.FakeModel(1))
+        assert len(cache) == 0
+
+
+class LoadManyTests(TestCase):
+
+    def test_by_name(self):
+        tag = Tag.objects.create(name='foo')
+        assert Tag.load_many(['foo', 'missing']) == [tag, None]
+
+    def test_by_guid(self):
+        user = OSFUser.objects.create(username='fred@example.com', fullname='Fred')
+        assert OSFUser.load_many([user._id, 'zzzzz']) == [user, None]
+
+    def test_fills_load_cache_under_load_keys(self):
+        tag = Tag.objects.create(name='foo')
+        user = OSFUser.objects.create(username='fred@example.com', fullname='Fred')
+        with cached_loads():
+            Tag.load_many(['foo'])
+            OSFUser.load_many([user._id])
+            with self.assertNumQueries(0):
+                assert Tag.load('foo') == tag
+                assert OSFUser.load(user._id) == user
+
+
+class PermissionCacheTests(TestCase):
+
+    def setUp(self):
+        self.creator = OSFUser.objects.create(username='fred@example.com', fullname='Fred')
+        self.user = OSFUser.objects.create(username='wilma@example.com', fullname='Wilma')
+        self.node = Node.objects.create(title='Project', creator=self.creator)
+
+    def add_contributor(self, user, **permissions):
+        return Contributor.objects.create(user=user, node=self.node, read=True, **permissions)
+
+    def test_request_auth_memoizes_checks(self):
+        self.add_contributor(self.user, write=True)
+        auth = Auth(self.user)
+        auth.permission_cache = PermissionCache()
+        assert self.node.can_view(auth)
+        assert self.node.can_edit(auth)
+        with self.assertNumQueries(0):
+            assert self.node.can_view(auth)
+            assert self.node.can_edit(auth)
+            assert self.node.has_permission(self.user, 'write', auth=auth)
+        assert auth.permission_cache.hits == 3
+
+    def test_auth_without_cache_is_not_memoized(self):
+        auth = Auth(self.user)
+        assert not self.node.can_edit(auth)
+        self.add_contributor(self.user, write=True)
+        assert self.node.can_edit(auth)
+
+    def test_saving_contributor_invalidates(self):
+        with cached_permissions():
+            assert not self.node.has_permission(self.user, 'write')
+            contributor = self.add_contributor(self.user)
+            assert not self.node.has_permission(self.user, 'write')
+            contributor.write = True
+            contributor.save()
+            assert self.node.has_permission(self.user, 'write')
+
+    def test_deleting_contributor_invalidates(self):
+        contributor = self.add_contributor(self.user, write=True)
+        with cached_permissions():
+            assert self.node.has_permission(self.user, 'write')
+            contributor.delete()
+            assert not self.node.has_permission(self.user, 'write')
+
+    def test_merge_user_invalidates(self):
+        merged = OSFUser.objects.create(username='barney@example.com', fullname='Barney')
+        Contributor.objects.create(user=merged, node=self.node, read=True, write=True)
+        with cached_permissions():
+            assert not self.node.has_permission(self.user, 'write')
+            self.user.merge_user(merged)
+            assert self.node.has_permission(self.user, 'write')
+            assert not self.node.has_permission(merged, 'write')
+
+
+class NodeTreeTests(TestCase):
+
+    def setUp(self):
+        self.creator = OSFUser.objects.create(username='fred@example.com', fullname='Fred')
+        self.project = Node.objects.create(title='Project', creator=self.creator)
+        self.component = Node.objects.create(title='Component', creator=self.creator, parent=self.project)
+        self.subcomponent = Node.objects.create(
+            title='Subcomponent', creator=self.creator, parent=self.component
+        )
+        self.other = Node.objects.create(title='Other', creator=self.creator)
+
+    def assert_path(self, node, ancestors):
+        node.refresh_from_db()
+        assert node.ancestor_ids == [ancestor.pk for ancestor in ancestors]
+        assert node.root_id == (ancestors[0] if ancestors else node).pk
+
+    def test_new_nodes(self):
+        self.assert_path(self.project, [])
+        self.assert_path(self.component, [self.project])
+        self.assert_path(self.subcomponent, [self.project, self.component])
+
+    def test_moving_node(self):
+        self.component.parent_node = self.other
+        self.component.save()
+        self.assert_path(self.component, [self.other])
+        self.assert_path(self.subcomponent, [self.other, self.component])
+        self.assert_path(self.project, [])
+
+    def test_moving_node_with_update(self):
+        Node.objects.filter(pk=self.component.pk).update(parent_node=self.other)
+        self.assert_path(self.component, [self.other])
+        self.assert_path(self.subcomponent, [self.other, self.component])
+
+    def test_moving_node_to_top_level(self):
+        self.component.parent_node = None
+        self.component.save()
+        self.assert_path(self.component, [])
+        self.assert_path(self.subcomponent, [self.component])
+
+
+class NodeSubtreeTests(TestCase):
+    """Checks the single query traversals against recursing through ``nodes``, which is
+    how they used to be implemented.
+    """
+
+    def setUp(self):
+        self.creator = OSFUser.objects.create(username='fred@example.com', fullname='Fred')
+        self.reader = OSFUser.objects.create(username='wilma@example.com', fullname='Wilma')
+        self.writer = OSFUser.objects.create(username='barney@example.com', fullname='Barney')
+        self.admin = OSFUser.objects.create(username='betty@example.com', fullname='Betty')
+        self.deleted_writer = OSFUser.objects.create(username='dino@example.com', fullname='Dino')
+        self.project = self.make_node('Project')
+        self.a = self.make_node('A', parent=self.project)
+        self.a1 = self.make_node('A1', parent=self.a)
+        self.a2 = self.make_node('A2', parent=self.a, is_deleted=True)
+        self.b = self.make_node('B', parent=self.project)
+        self.b1 = self.make_node('B1', parent=self.b)
+        self.other = self.make_node('Other')
+        Contributor.objects.create(user=self.reader, node=self.a1, read=True)
+        Contributor.objects.create(user=self.writer, node=self.b, read=True, write=True)
+        Contributor.objects.create(user=self.admin, node=self.a, read=True, write=True, admin=True)
+        Contributor.objects.create(user=self.deleted_writer, node=self.a2, read=True, write=True)
+        self.users = [self.creator, self.reader, self.writer, self.admin, self.deleted_writer]
+        self.nodes = [self.project, self.a, self.a1, self.a2, self.b, self.b1, self.other]
+
+    def make_node(self, title, **kwargs):
+        return Node.objects.create(title=title, creator=self.creator, **kwargs)
+
+    def recursive_descendants(self, node, include=lambda n: True):
+        for child in node.nodes.all():
+            if include(child):
+                yield child
+            if child.primary:
+                for descendant in self.recursive_descendants(child, include):
+                    if include(descendant):
+                        yield descendant
+
+    def recursive_has_permission_on_children(self, node, user, permission):
+        if node.has_permission(user, permission):
+            return True
+        return any(
+            self.recursive_has_permission_on_children(child, user, permission)
+            for child in node.nodes.filter(is_deleted=False)
+        )
+
+    def test_subtree(self):
+        assert self.project._get_subtree() == {
+            self.project.pk: [self.a, self.b],
+            self.a.pk: [self.a1, self.a2],
+            self.b.pk: [self.b1],
+        }
+        assert self.b1._get_subtree() == {}
+
+    def test_descendants_are_in_recursive_order(self):
+        for node in self.nodes:
+            assert list(node.get_descendants_recursive()) == list(self.recursive_descendants(node))
+        assert list(self.project.get_descendants_recursive()) == [self.a, self.a1, self.a2, self.b, self.b1]
+
+    def test_descendants_with_include(self):
+        include = lambda n: n.title != 'B'
+        assert (list(self.project.get_descendants_recursive(include)) ==
+                list(self.recursive_descendants(self.project, include)))
+
+    def test_has_permission_on_children(self):
+        for user in self.users:
+            for permission in ('read', 'write', 'admin'):
+                for node in self.nodes:
+                    assert (node.has_permission_on_children(user, permission) ==
+                            self.recursive_has_permission_on_children(node, user, permission))
+        assert self.project.has_permission_on_children(self.writer, 'write')
+        assert not self.project.has_permission_on_children(self.reader, 'write')
+        assert not self.project.has_permission_on_children(self.deleted_writer, 'write')
+
+    def test_permission_resolver_matches_nodes(self):
+        for user in self.users:
+            resolver = PermissionResolver(user, self.a)
+            for node in self.nodes:
+                assert resolver.is_admin_parent(node) == node.is_admin_parent(user)
+                for permission in ('read', 'write', 'admin'):
+                    assert resolver.has_permission(node, permission) == node.has_permission(user, permission)
+                    assert (resolver.has_permission(node, permission, check_parent=False) ==
+                            node.has_permission(user, permission, check_parent=False))
+
+    def test_permission_resolver_queries_once(self):
+        resolver = PermissionResolver(self.admin, self.a)
+        assert resolver.covers(self.project)
+        assert resolver.covers(self.a1)
+        assert not resolver.covers(self.b)
+        with self.assertNumQueries(1):
+            assert resolver.has_permission(self.a2, 'read')
+            assert not resolver.has_permission(self.a1, 'write')
+            assert resolver.is_admin_parent(self.a1)
+            assert not resolver.has_permission(self.project, 'read')
+
+
+class EffectivePermissionTests(TestCase):
+
+    def setUp(self):
+        self.creator = OSFUser.objects.create(username='fred@example.com', fullname='Fred')
+        self.user = OSFUser.objects.create(username='wilma@example.com', fullname='Wilma')
+        self.project = Node.objects.create(title='Project', creator=self.creator)
+        self.component = Node.objects.create(title='Component', creator=self.creator, parent=self.project)
+
+    def permissions(self, user):
+        return set(EffectivePermission.objects.filter(user=user).values_list('node_id', 'level', 'source_id'))
+
+    def test_admins_can_read_descendants(self):
+        assert self.permissions(self.creator) == {
+            (self.project.pk, 'admin', self.project.pk),
+            (self.component.pk, 'admin', self.component.pk),
+            (self.component.pk, 'read', self.project.pk),
+        }
+
+    def test_adding_contributor(self):
+        Contributor.objects.create(user=self.user, node=self.project, read=True, write=True)
+        assert self.permissions(self.user) == {(self.project.pk, 'write', self.project.pk)}
+        assert list(Node.find_for_user(self.user)) == [self.project]
+        assert list(Node.find_for_user(self.user, inherited=True)) == [self.project]
+
+    def test_promoting_contributor_to_admin(self):
+        contributor = Contributor.objects.create(user=self.user, node=self.project, read=True)
+        contributor.write = contributor.admin = True
+        contributor.save()
+        assert self.permissions(self.user) == {
+            (self.project.pk, 'admin', self.project.pk),
+            (self.component.pk, 'read', self.project.pk),
+        }
+        assert list(Node.find_for_user(self.user)) == [self.project]
+        assert set(Node.find_for_user(self.user, inherited=True)) == {self.project, self.component}
+        assert list(self.project.find_readable_descendants(Auth(self.user))) == [self.component]
+
+    def test_removing_contributor(self):
+        contributor = Contributor.objects.create(user=self.user, node=self.project, read=True, admin=True)
+        contributor.delete()
+        assert self.permissions(self.user) == set()
+        assert list(self.project.find_readable_descendants(Auth(self.user))) == []
+
+    def test_moving_node(self):
+        other = Node.objects.create(title='Other', creator=self.user)
+        self.component.parent_node = other
+        self.component.save()
+        assert (self.component.pk, 'read', other.pk) in self.permissions(self.user)
+        assert (self.component.pk, 'read', self.project.pk) not in self.permissions(self.creator)
+
+
+class LookupTableCacheTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'lookups.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_build_over_all_models(self):
+        from osf_models.management.commands.migraterelations import build_toku_django_lookup_table_cache
+        user = OSFUser.objects.create(username='fred@example.com', fullname='Fred')
+        node = Node.objects.create(title='Project', creator=user)
+        tag = Tag.objects.create(name='foo')
+        lookups = build_toku_django_lookup_table_cache(self.path)
+        assert lookups[user._id] == user.pk
+        assert lookups[node._id] == node.pk
+        assert lookups['foo:not_system'] == tag.pk
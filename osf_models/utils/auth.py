@@ -5,6 +5,7 @@ from modularodm.exceptions import QueryException
 from modularodm import Q
 
 from framework.sessions import session
+from osf_models.utils.permission_cache import PermissionCache
 
 logger = logging.getLogger(__name__)
 
@@ -62,6 +63,7 @@ class Auth(object):
         self.user = user
         self.api_node = api_node
         self.private_key = private_key
+        self.permission_cache = None
 
     def __repr__(self):
         return ('<Auth(user="{self.user}", '
@@ -93,7 +95,10 @@ class Auth(object):
     def from_kwargs(cls, request_args, kwargs):
         user = request_args.get('user') or kwargs.get('user') or _get_current_user()
         private_key = request_args.get('view_only')
-        return cls(
+        auth = cls(
             user=user,
             private_key=private_key,
         )
+        # Permission checks are memoized for the rest of the request
+        auth.permission_cache = PermissionCache()
+        return auth
@@ -0,0 +1,118 @@
+import datetime as dt
+from cStringIO import StringIO
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.db.models import AutoField
+from psycopg2.extras import Json
+
+
+class BulkCreateWriter(object):
+    """Writes unsaved model instances with ``bulk_create``."""
+
+    def __init__(self, django_model, using=DEFAULT_DB_ALIAS):
+        self.django_model = django_model
+        self.using = using
+
+    def write(self, django_objects):
+        """Insert django_objects, returning the number of rows written."""
+        return len(self.django_model.objects.using(self.using).bulk_create(django_objects))
+
+
+class CopyWriter(BulkCreateWriter):
+    """Writes unsaved model instances by streaming them into postgres with
+    ``COPY ... FROM STDIN`` in CSV format.
+
+    Column values are resolved the same way ``bulk_create`` resolves them
+    (``pre_save`` then ``get_db_prep_save``), so defaults and ``auto_now_add``
+    fields end up in the rows instead of being left to the INSERT.
+    """
+
+    def __init__(self, django_model, using=DEFAULT_DB_ALIAS):
+        super(CopyWriter, self).__init__(django_model, using=using)
+        self.connection = connections[using]
+        self.fields = list(django_model._meta.concrete_fields)
+
+    def get_fields(self, django_objects):
+        # Like bulk_create, let the database assign primary keys unless every object already has one
+        if any(obj.pk is None for obj in django_objects):
+            return [field for field in self.fields if not isinstance(field, AutoField)]
+        return self.fields
+
+    def get_row(self, fields, django_obj):
+        return [
+            format_copy_value(
+                field.get_db_prep_save(field.pre_save(django_obj, True), connection=self.connection)
+            )
+            for field in fields
+        ]
+
+    def write(self, django_objects):
+        if not django_objects:
+            return 0
+        fields = self.get_fields(django_objects)
+
+        buf = StringIO()
+        for django_obj in django_objects:
+            buf.write(','.join(self.get_row(fields, django_obj)))
+            buf.write('\n')
+        buf.seek(0)
+
+        quote_name = self.connection.ops.quote_name
+        sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            quote_name(self.django_model._meta.db_table),
+            ', '.join(quote_name(field.column) for field in fields)
+        )
+        with self.connection.cursor() as cursor:
+            cursor.copy_expert(sql, buf)
+        return len(django_objects)
+
+
+WRITERS = {
+    'bulk_create': BulkCreateWriter,
+    'copy': CopyWriter,
+}
+
+
+def get_writer(name, django_model, using=DEFAULT_DB_ALIAS):
+    try:
+        writer_cls = WRITERS[name]
+    except KeyError:
+        raise ValueError('Unknown writer {!r}, expected one of {}'.format(name, ', '.join(sorted(WRITERS))))
+    return writer_cls(django_model, using=using)
+
+
+def _to_text(value):
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, (dt.datetime, dt.date, dt.time)):
+        return value.isoformat()
+    elif isinstance(value, Json):
+        return value.dumps(value.adapted)
+    elif isinstance(value, (list, tuple)):
+        return _format_array(value)
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _format_array(values):
+    """Format a list as a postgres array literal, e.g. ``{"a","b",NULL}``."""
+    items = []
+    for item in values:
+        if item is None:
+            items.append('NULL')
+        elif isinstance(item, (list, tuple)):
+            items.append(_format_array(item))
+        else:
+            items.append('"{}"'.format(_to_text(item).replace('\\', '\\\\').replace('"', '\\"')))
+    return '{{{}}}'.format(','.join(items))
+
+
+def format_copy_value(value):
+    """Format a value returned by ``get_db_prep_save`` as a CSV field for ``COPY``.
+    NULLs are unquoted empty fields, everything else is quoted.
+    """
+    if value is None:
+        return ''
+    return '"{}"'.format(_to_text(value).replace('"', '""'))
@@ -0,0 +1,190 @@
+import json
+import os
+import re
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.utils import timezone
+
+INDEXES_SQL = """
+SELECT index_class.relname, pg_get_indexdef(index_class.oid)
+FROM pg_index
+JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+WHERE pg_index.indrelid = %s::regclass
+AND NOT pg_index.indisprimary
+AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE pg_constraint.conindid = pg_index.indexrelid)
+"""
+
+CONSTRAINTS_SQL = """
+SELECT conname, contype, pg_get_constraintdef(oid), pg_get_indexdef(conindid)
+FROM pg_constraint
+WHERE conrelid = %s::regclass
+AND contype IN ('f', 'u')
+"""
+
+INDEX_VALID_SQL = """
+SELECT pg_index.indisvalid
+FROM pg_index
+JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+WHERE index_class.relname = %s
+"""
+
+CONSTRAINT_EXISTS_SQL = """
+SELECT 1 FROM pg_constraint WHERE conname = %s AND conrelid = %s::regclass
+"""
+
+CREATE_INDEX_RE = re.compile(r'^CREATE (UNIQUE )?INDEX ')
+
+
+class deferred_indexes(object):
+    """
+    With block helper that drops the non primary key indexes and foreign key constraints
+    on the tables of some models, and rebuilds them when the block exits.
+
+    Unique constraints are kept unless ``keep_unique=False``, since the migration relies
+    on them to skip rows that already exist. Indexes are rebuilt CONCURRENTLY and foreign
+    keys are added NOT VALID then validated, so the block must not be used inside a
+    transaction.
+
+    If ``state_file`` is given, the definitions of everything dropped are saved there
+    before it's dropped and the file is removed once they're rebuilt. A run that dies
+    in between leaves the file behind, and the next run restores what it lists along
+    with what it drops itself. Restoring skips whatever already exists again.
+
+    Usage:
+
+    with deferred_indexes([Node, NodeLog]):
+        save_bare_models(...)
+    """
+
+    def __init__(self, models, using=DEFAULT_DB_ALIAS, keep_unique=True, concurrently=True,
+                 state_file=None):
+        self.connection = connections[using]
+        self.keep_unique = keep_unique
+        self.concurrently = concurrently
+        self.state_file = state_file
+        # Typed models share their parent's table
+        self.tables = []
+        for model in models:
+            if model._meta.db_table not in self.tables:
+                self.tables.append(model._meta.db_table)
+        # (table, name, definition)
+        self.indexes = []
+        # (table, name, type, definition, index definition)
+        self.constraints = []
+
+    def __enter__(self):
+        self.drop()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.restore()
+
+    def _execute(self, cursor, sql):
+        start = timezone.now()
+        cursor.execute(sql)
+        print('{} in {} seconds'.format(sql, (timezone.now() - start).total_seconds()))
+
+    def load_state(self):
+        """Pick up what an earlier run dropped but never restored, if anything."""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        with open(self.state_file) as fp:
+            state = json.load(fp)
+        self.indexes = [tuple(index) for index in state['indexes']]
+        self.constraints = [tuple(constraint) for constraint in state['constraints']]
+        print('Found {} indexes and {} constraints dropped by an earlier run in {}'.format(
+            len(self.indexes), len(self.constraints), self.state_file))
+
+    def save_state(self):
+        if not self.state_file:
+            return
+        partial_path = self.state_file + '.partial'
+        with open(partial_path, 'w') as fp:
+            json.dump({'indexes': self.indexes, 'constraints': self.constraints}, fp, indent=2)
+        os.rename(partial_path, self.state_file)
+
+    def drop(self):
+        quote_name = self.connection.ops.quote_name
+        self.load_state()
+        dropped_constraints = []
+        dropped_indexes = []
+        with self.connection.cursor() as cursor:
+            for table in self.tables:
+                cursor.execute(CONSTRAINTS_SQL, [table])
+                for name, contype, definition, index_definition in cursor.fetchall():
+                    if contype == 'u' and self.keep_unique:
+                        continue
+                    dropped_constraints.append((table, name, contype, definition, index_definition))
+                cursor.execute(INDEXES_SQL, [table])
+                for name, definition in cursor.fetchall():
+                    if self.keep_unique and definition.startswith('CREATE UNIQUE INDEX '):
+                        continue
+                    dropped_indexes.append((table, name, definition))
+
+            # An earlier run may have restored some of what it dropped before dying
+            saved_names = {constraint[1] for constraint in self.constraints}
+            saved_names.update(index[1] for index in self.indexes)
+            self.constraints.extend(
+                constraint for constraint in dropped_constraints if constraint[1] not in saved_names
+            )
+            self.indexes.extend(index for index in dropped_indexes if index[1] not in saved_names)
+            # Save and print what's being dropped so it can be recreated if we never get to restore
+            self.save_state()
+            for table, name, contype, definition, index_definition in dropped_constraints:
+                print('Dropping constraint {} on {}: {}'.format(name, table, definition))
+                self._execute(cursor, 'ALTER TABLE {} DROP CONSTRAINT {}'.format(
+                    quote_name(table), quote_name(name)))
+            for table, name, definition in dropped_indexes:
+                print('Dropping index {} on {}: {}'.format(name, table, definition))
+                self._execute(cursor, 'DROP INDEX {}'.format(quote_name(name)))
+
+    def _create_index_sql(self, definition):
+        if not self.concurrently:
+            return definition
+        return CREATE_INDEX_RE.sub(lambda match: 'CREATE {}INDEX CONCURRENTLY '.format(match.group(1) or ''),
+                                   definition)
+
+    def _create_index(self, cursor, name, definition):
+        """Create an index unless it already exists. Concurrent builds that died leave an
+        invalid index behind, which is dropped and built again.
+        """
+        cursor.execute(INDEX_VALID_SQL, [name])
+        row = cursor.fetchone()
+        if row is not None:
+            if row[0]:
+                return
+            self._execute(cursor, 'DROP INDEX {}'.format(self.connection.ops.quote_name(name)))
+        self._execute(cursor, self._create_index_sql(definition))
+
+    def _constraint_exists(self, cursor, table, name):
+        cursor.execute(CONSTRAINT_EXISTS_SQL, [name, table])
+        return cursor.fetchone() is not None
+
+    def restore(self):
+        print('Rebuilding indexes and constraints on {}...'.format(', '.join(self.tables)))
+        start = timezone.now()
+        quote_name = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            for table, name, definition in self.indexes:
+                self._create_index(cursor, name, definition)
+            for table, name, contype, definition, index_definition in self.constraints:
+                if contype == 'u' and not self._constraint_exists(cursor, table, name):
+                    # Build the index first so the constraint doesn't lock the table while it's built
+                    self._create_index(cursor, name, index_definition)
+                    self._execute(cursor, 'ALTER TABLE {} ADD CONSTRAINT {} UNIQUE USING INDEX {}'.format(
+                        quote_name(table), quote_name(name), quote_name(name)))
+            for table, name, contype, definition, index_definition in self.constraints:
+                if contype == 'f':
+                    if not self._constraint_exists(cursor, table, name):
+                        self._execute(cursor, 'ALTER TABLE {} ADD CONSTRAINT {} {} NOT VALID'.format(
+                            quote_name(table), quote_name(name), definition))
+                    # Also finishes constraints added by a run that died before validating them
+                    self._execute(cursor, 'ALTER TABLE {} VALIDATE CONSTRAINT {}'.format(
+                        quote_name(table), quote_name(name)))
+        self.indexes = []
+        self.constraints = []
+        if self.state_file and os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        print('Done rebuilding indexes and constraints on {} in {} seconds...'.format(
+            ', '.join(self.tables), (timezone.now() - start).total_seconds()))
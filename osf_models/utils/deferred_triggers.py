@@ -0,0 +1,114 @@
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.db import transaction
+from django.utils import timezone
+
+# (table, trigger) for the triggers that keep AbstractNode.ancestor_ids, root_id and
+# EffectivePermission up to date, see migrations 0004, 0005 and 0006
+NODE_TREE_TRIGGERS = (
+    ('osf_models_abstractnode', 'osf_models_abstractnode_set_ancestor_ids'),
+    ('osf_models_abstractnode', 'osf_models_abstractnode_update_descendant_ancestor_ids'),
+    ('osf_models_abstractnode', 'osf_models_abstractnode_update_effective_permissions'),
+    ('osf_models_contributor', 'osf_models_contributor_update_effective_permissions'),
+)
+
+DISABLED_TRIGGERS_SQL = """
+SELECT tgname FROM pg_trigger WHERE tgname IN %s AND tgenabled = 'D'
+"""
+
+# Same as the backfills in migrations 0004, 0005 and 0006, rebuilding everything
+REBUILD_NODE_TREE_SQL = (
+    """
+    WITH RECURSIVE paths AS (
+        SELECT id, ARRAY[]::integer[] AS ancestor_ids
+        FROM osf_models_abstractnode
+        WHERE parent_node_id IS NULL
+        UNION ALL
+        SELECT child.id, paths.ancestor_ids || paths.id
+        FROM osf_models_abstractnode child
+        JOIN paths ON child.parent_node_id = paths.id
+    )
+    UPDATE osf_models_abstractnode
+    SET ancestor_ids = paths.ancestor_ids, root_id = COALESCE(paths.ancestor_ids[1], paths.id)
+    FROM paths
+    WHERE osf_models_abstractnode.id = paths.id
+    AND (osf_models_abstractnode.ancestor_ids IS DISTINCT FROM paths.ancestor_ids OR
+         osf_models_abstractnode.root_id IS DISTINCT FROM COALESCE(paths.ancestor_ids[1], paths.id))
+    """,
+    'TRUNCATE osf_models_effectivepermission',
+    """
+    INSERT INTO osf_models_effectivepermission (user_id, node_id, level, source_id)
+    SELECT contributor.user_id, contributor.node_id,
+        CASE WHEN contributor.admin THEN 'admin' WHEN contributor.write THEN 'write' ELSE 'read' END,
+        contributor.node_id
+    FROM osf_models_contributor contributor
+    WHERE contributor.read OR contributor.write OR contributor.admin
+    """,
+    """
+    INSERT INTO osf_models_effectivepermission (user_id, node_id, level, source_id)
+    SELECT contributor.user_id, descendant.id, 'read', contributor.node_id
+    FROM osf_models_contributor contributor
+    JOIN osf_models_abstractnode descendant ON descendant.ancestor_ids @> ARRAY[contributor.node_id]
+    WHERE contributor.admin
+    """,
+)
+
+
+class deferred_node_triggers(object):
+    """
+    With block helper that disables the triggers that maintain AbstractNode.ancestor_ids
+    and EffectivePermission, and rebuilds both in bulk when the block exits.
+
+    Setting parent_node_id row by row makes the triggers rewrite the paths and
+    permissions of every descendant each time, which is far slower than rebuilding them
+    once at the end. If the process is killed inside the block, the triggers stay disabled
+    until a later block rebuilds and re-enables them; ``get_disabled`` tells if that's
+    the case.
+
+    Usage:
+
+    with deferred_node_triggers():
+        save_fk_relationships(...)
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+
+    def __enter__(self):
+        self.disable()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.restore()
+
+    def _execute(self, cursor, sql):
+        start = timezone.now()
+        cursor.execute(sql)
+        print('{} in {} seconds'.format(' '.join(sql.split()), (timezone.now() - start).total_seconds()))
+
+    def _alter_triggers(self, cursor, action):
+        quote_name = self.connection.ops.quote_name
+        for table, trigger in NODE_TREE_TRIGGERS:
+            self._execute(cursor, 'ALTER TABLE {} {} TRIGGER {}'.format(
+                quote_name(table), action, quote_name(trigger)))
+
+    def get_disabled(self):
+        """Names of the triggers that are disabled right now."""
+        with self.connection.cursor() as cursor:
+            cursor.execute(DISABLED_TRIGGERS_SQL, [tuple(trigger for table, trigger in NODE_TREE_TRIGGERS)])
+            return [row[0] for row in cursor.fetchall()]
+
+    def disable(self):
+        with self.connection.cursor() as cursor:
+            self._alter_triggers(cursor, 'DISABLE')
+
+    def restore(self):
+        print('Rebuilding ancestor_ids and effective permissions...')
+        start = timezone.now()
+        with transaction.atomic(using=self.connection.alias):
+            with self.connection.cursor() as cursor:
+                for sql in REBUILD_NODE_TREE_SQL:
+                    self._execute(cursor, sql)
+                self._alter_triggers(cursor, 'ENABLE')
+        print('Done rebuilding ancestor_ids and effective permissions in {} seconds...'.format(
+            (timezone.now() - start).total_seconds()))
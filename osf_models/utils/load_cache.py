@@ -0,0 +1,146 @@
+import functools
+import threading
+from collections import OrderedDict
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+_local = threading.local()
+
+
+class LoadCache(object):
+    """
+    A least recently used identity map of the instances returned by ``Model.load``,
+    keyed by (model, _id).
+
+    Entries are dropped when their instance is saved or deleted through the ORM.
+    Rows changed with ``QuerySet.update`` or raw SQL aren't noticed, so a cache should
+    only live as long as a request or a script that doesn't do those.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # (model, key) -> instance
+        self._instances = OrderedDict()
+        # (concrete model, pk) -> set of (model, key), for invalidation
+        self._keys_by_pk = {}
+
+    def __len__(self):
+        return len(self._instances)
+
+    def __repr__(self):
+        return '<LoadCache(size={}, hits={}, misses={})>'.format(len(self), self.hits, self.misses)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else None
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio,
+        }
+
+    def get(self, model, key):
+        """Get the cached instance for key, or None. Counts as a hit or a miss."""
+        instance = self._instances.pop((model, key), None)
+        if instance is None:
+            self.misses += 1
+            return None
+        # Re-insert to mark it as the most recently used
+        self._instances[(model, key)] = instance
+        self.hits += 1
+        return instance
+
+    def set(self, model, key, instance):
+        self._instances.pop((model, key), None)
+        self._instances[(model, key)] = instance
+        self._keys_by_pk.setdefault(self._pk_key(instance), set()).add((model, key))
+        while len(self._instances) > self.maxsize:
+            evicted_key, evicted = self._instances.popitem(last=False)
+            self._discard_pk_key(evicted, evicted_key)
+
+    def invalidate(self, instance):
+        """Drop every entry for instance, under any model or key it was loaded by."""
+        for cache_key in self._keys_by_pk.pop(self._pk_key(instance), ()):
+            self._instances.pop(cache_key, None)
+
+    def clear(self):
+        self._instances.clear()
+        self._keys_by_pk.clear()
+
+    def _pk_key(self, instance):
+        # Typed models are cached under their proxy classes but saved as any of them
+        return (instance._meta.concrete_model, instance.pk)
+
+    def _discard_pk_key(self, instance, cache_key):
+        pk_key = self._pk_key(instance)
+        keys = self._keys_by_pk.get(pk_key)
+        if keys is not None:
+            keys.discard(cache_key)
+            if not keys:
+                del self._keys_by_pk[pk_key]
+
+
+def get_load_cache():
+    """The LoadCache active on this thread, if any."""
+    return getattr(_local, 'cache', None)
+
+
+class cached_loads(object):
+    """
+    With block helper that makes ``load`` calls on this thread go through a LoadCache.
+    Blocks can be nested; the innermost cache is used.
+
+    Usage:
+
+    with cached_loads(maxsize=500) as cache:
+        node = Node.load('abc12')
+        assert Node.load('abc12') is node
+    print(cache.stats())
+    """
+
+    def __init__(self, maxsize=1000, cache=None):
+        self.cache = cache if cache is not None else LoadCache(maxsize=maxsize)
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = get_load_cache()
+        _local.cache = self.cache
+        return self.cache
+
+    def __exit__(self, type, value, traceback):
+        _local.cache = self.previous
+        self.previous = None
+
+
+def cached_load(func):
+    """Decorator for ``load`` classmethods that looks instances up in the active LoadCache
+    first. Put it under ``@classmethod``.
+    """
+    @functools.wraps(func)
+    def wrapped(cls, data):
+        cache = get_load_cache()
+        if cache is None:
+            return func(cls, data)
+        instance = cache.get(cls, data)
+        if instance is None:
+            instance = func(cls, data)
+            if instance is not None:
+                cache.set(cls, data, instance)
+        return instance
+    return wrapped
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_load_cache(sender, instance, **kwargs):
+    cache = get_load_cache()
+    if cache is not None:
+        cache.invalidate(instance)
@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import tempfile
+from itertools import islice
+
+
+class LookupTable(object):
+    """A read-mostly mapping of string keys (modm _ids) to integer pks that lives in a
+    sqlite file rather than in memory.
+
+    The file is built once and can then be opened by any number of processes; each
+    process lazily opens its own connection, so instances can be pickled and handed
+    to workers.
+
+    Usage:
+
+    table = LookupTable.build('/tmp/lookups.sqlite3', Node.objects.values_list('guid__guid', 'pk'))
+    table['abc12']
+    """
+
+    BATCH_SIZE = 100000
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __repr__(self):
+        return '<LookupTable({!r})>'.format(self.path)
+
+    @property
+    def connection(self):
+        # sqlite connections can't be shared with forked processes
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute('PRAGMA query_only = ON')
+            self._pid = os.getpid()
+        return self._connection
+
+    @classmethod
+    def build(cls, path, items=()):
+        """Create the lookup file at path, replacing any existing one, and fill it with
+        (key, pk) pairs from items.
+
+        The file is built under a temporary name next to path and only renamed into place
+        once it's complete, so a build that dies partway never leaves a truncated file at
+        path to be reused.
+        """
+        directory, filename = os.path.split(os.path.abspath(path))
+        fd, partial_path = tempfile.mkstemp(prefix=filename + '.', suffix='.partial', dir=directory)
+        os.close(fd)
+        try:
+            connection = sqlite3.connect(partial_path)
+            try:
+                connection.execute('PRAGMA journal_mode = OFF')
+                connection.execute('PRAGMA synchronous = OFF')
+                connection.execute(
+                    'CREATE TABLE lookup (key TEXT PRIMARY KEY, pk INTEGER NOT NULL) WITHOUT ROWID'
+                )
+                connection.commit()
+            finally:
+                connection.close()
+            cls(partial_path).update(items)
+            os.rename(partial_path, path)
+        except BaseException:
+            os.remove(partial_path)
+            raise
+        return cls(path)
+
+    def update(self, items):
+        """Add (key, pk) pairs from items, or from a dict. Later keys replace earlier ones."""
+        if isinstance(items, dict):
+            items = items.iteritems()
+        items = iter(items)
+        # Writes go through their own connection, the shared one is read only
+        connection = sqlite3.connect(self.path)
+        try:
+            while True:
+                batch = list(islice(items, self.BATCH_SIZE))
+                if not batch:
+                    break
+                connection.executemany('INSERT OR REPLACE INTO lookup (key, pk) VALUES (?, ?)', batch)
+                connection.commit()
+        finally:
+            connection.close()
+
+    def get(self, key, default=None):
+        row = self.connection.execute('SELECT pk FROM lookup WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def __getitem__(self, key):
+        pk = self.get(key)
+        if pk is None:
+            raise KeyError(key)
+        return pk
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM lookup').fetchone()[0]
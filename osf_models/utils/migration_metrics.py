@@ -0,0 +1,182 @@
+import gc
+import json
+import os
+import resource
+import time
+from collections import OrderedDict
+
+from bson import BSON
+
+
+def get_rss_mb():
+    """Resident set size of this process in MB. Falls back to the peak RSS where
+    /proc isn't available.
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+        return pages * resource.getpagesize() / 1024.0 / 1024.0
+    except (IOError, IndexError, ValueError):
+        # ru_maxrss is in KB on linux, bytes on OS X
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def get_size(modm_obj):
+    """Approximate number of bytes read from mongo for modm_obj."""
+    return len(BSON.encode(modm_obj.to_storage()))
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class MigrationMetrics(object):
+    """
+    Collects throughput metrics for the tokumx to postgres migration per model and
+    phase, and emits a JSON line for every page and every finished model.
+
+    Lines are appended to ``path``, or printed if there isn't one. Each line is
+    written with a single call, so several worker processes can share a file.
+
+    Bytes read are estimated from every ``size_sample_rate``th object, since measuring
+    one means serializing it again.
+    """
+
+    def __init__(self, path=None, size_sample_rate=100):
+        self.path = path
+        self.size_sample_rate = size_sample_rate
+        self._objects_seen = 0
+        # (model, phase) -> totals
+        self.totals = OrderedDict()
+        # finished model records, in the order they finished
+        self.records = []
+
+    def emit(self, record):
+        line = json.dumps(record, sort_keys=True)
+        if self.path:
+            with open(self.path, 'a') as fp:
+                fp.write(line + '\n')
+        else:
+            print(line)
+
+    def sample_size(self, modm_obj):
+        """Estimated bytes read for modm_obj: the size of every size_sample_rate'th object
+        times size_sample_rate, 0 for the rest.
+        """
+        self._objects_seen += 1
+        if self._objects_seen % self.size_sample_rate:
+            return 0
+        return get_size(modm_obj) * self.size_sample_rate
+
+    def collect_garbage(self):
+        """gc.collect(), timed. Returns the number of objects collected and the seconds it took."""
+        start = time.time()
+        collected = gc.collect()
+        return collected, time.time() - start
+
+    def page(self, model, phase, rows_read, rows_written, bytes_read, read_seconds, write_seconds,
+             gc_seconds=0.0):
+        """Record a page of rows read from mongo and written to postgres."""
+        totals = self.totals.setdefault((model, phase), {
+            'rows_read': 0,
+            'rows_written': 0,
+            'bytes_read': 0,
+            'read_seconds': 0.0,
+            'write_seconds': 0.0,
+            'gc_seconds': 0.0,
+            'pages': 0,
+            'peak_rss_mb': 0.0,
+            'write_latencies': [],
+        })
+        rss_mb = get_rss_mb()
+        totals['rows_read'] += rows_read
+        totals['rows_written'] += rows_written
+        totals['bytes_read'] += bytes_read
+        totals['read_seconds'] += read_seconds
+        totals['write_seconds'] += write_seconds
+        totals['gc_seconds'] += gc_seconds
+        totals['pages'] += 1
+        totals['peak_rss_mb'] = max(totals['peak_rss_mb'], rss_mb)
+        totals['write_latencies'].append(write_seconds)
+
+        seconds = read_seconds + write_seconds + gc_seconds
+        self.emit({
+            'event': 'page',
+            'model': model,
+            'phase': phase,
+            'pid': os.getpid(),
+            'page': totals['pages'],
+            'rows_read': rows_read,
+            'rows_written': rows_written,
+            'mb_read': bytes_read / 1024.0 / 1024.0,
+            'read_seconds': read_seconds,
+            'write_seconds': write_seconds,
+            'gc_seconds': gc_seconds,
+            'rows_per_second': rows_read / seconds if seconds else None,
+            'rss_mb': rss_mb,
+        })
+
+    def finish(self, model, phase):
+        """Emit and return the totals for a finished model and phase."""
+        totals = self.totals.pop((model, phase), None)
+        if totals is None:
+            return None
+        latencies = totals.pop('write_latencies')
+        seconds = totals['read_seconds'] + totals['write_seconds'] + totals['gc_seconds']
+        record = {
+            'event': 'model',
+            'model': model,
+            'phase': phase,
+            'pid': os.getpid(),
+            'pages': totals['pages'],
+            'rows_read': totals['rows_read'],
+            'rows_written': totals['rows_written'],
+            'mb_read': totals['bytes_read'] / 1024.0 / 1024.0,
+            'seconds': seconds,
+            'rows_per_second': totals['rows_read'] / seconds if seconds else None,
+            'write_seconds': totals['write_seconds'],
+            'write_p50': percentile(latencies, 50),
+            'write_p95': percentile(latencies, 95),
+            'write_p99': percentile(latencies, 99),
+            'gc_seconds': totals['gc_seconds'],
+            'peak_rss_mb': totals['peak_rss_mb'],
+        }
+        self.emit(record)
+        self.records.append(record)
+        return record
+
+    def add(self, records):
+        """Add model records that were finished elsewhere, e.g. in a worker process."""
+        self.records.extend(records)
+
+    def summary(self):
+        """Print a table of the finished models, slowest first."""
+        # (key, heading, width, value format)
+        columns = (
+            ('model', 'model', -28, ''),
+            ('phase', 'phase', -12, ''),
+            ('rows_read', 'rows', 10, ''),
+            ('seconds', 'seconds', 9, '.1f'),
+            ('rows_per_second', 'rows/s', 9, '.0f'),
+            ('mb_read', 'MB read', 9, '.1f'),
+            ('write_p50', 'p50 write', 9, '.3f'),
+            ('write_p95', 'p95 write', 9, '.3f'),
+            ('write_p99', 'p99 write', 9, '.3f'),
+            ('gc_seconds', 'gc secs', 9, '.1f'),
+            ('peak_rss_mb', 'RSS MB', 9, '.0f'),
+        )
+
+        def cell(value, width, fmt=''):
+            align = '<' if width < 0 else '>'
+            if value is None:
+                value, fmt = '-', ''
+            return '{{:{}{}{}}}'.format(align, abs(width), fmt).format(value)
+
+        print(' '.join(cell(heading, width) for key, heading, width, fmt in columns))
+        for record in sorted(self.records, key=lambda record: record['seconds'], reverse=True):
+            print(' '.join(cell(record[key], width, fmt) for key, heading, width, fmt in columns))
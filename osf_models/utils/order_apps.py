@@ -2,22 +2,16 @@ from collections import OrderedDict
 
 from django.apps import apps
 
-def sort_dependencies(app_list):
-    """Sort a list of (app_label, models) pairs into a single list of models.
-
-    The single list of models is sorted so that any model with a natural key
-    is serialized before a normal model, and any model with a natural key
-    dependency has it's dependencies serialized first.
+def get_model_dependencies(app_list):
+    """Given a list of (app_label, models) pairs, return a list of
+    (model, dependencies) pairs, one for each model.
     """
-    # Process the list of models, and get the list of dependencies
     model_dependencies = []
-    models = set()
     for app_label, model_list in app_list.iteritems():
         if model_list is None:
             model_list = apps.get_app_config(app_label).models
 
         for model in model_list:
-            models.add(model)
             # Add any explicitly defined dependencies
             if hasattr(model, 'natural_key'):
                 deps = getattr(model.natural_key, 'dependencies', [])
@@ -43,6 +37,19 @@ def sort_dependencies(app_list):
                         deps.append(rel_model)
 
             model_dependencies.append((model, deps))
+    return model_dependencies
+
+
+def sort_dependencies(app_list):
+    """Sort a list of (app_label, models) pairs into a single list of models.
+
+    The single list of models is sorted so that any model with a natural key
+    is serialized before a normal model, and any model with a natural key
+    dependency has it's dependencies serialized first.
+    """
+    # Process the list of models, and get the list of dependencies
+    model_dependencies = get_model_dependencies(app_list)
+    models = set(model for model, deps in model_dependencies)
 
     model_dependencies.reverse()
     # Now sort the models to ensure that dependencies are met. This
@@ -82,7 +89,7 @@ def sort_dependencies(app_list):
     return model_list
 
 
-def get_ordered_models():
+def get_model_mapping():
     all_models = apps.all_models
 
     model_mapping = OrderedDict()
@@ -95,8 +102,23 @@ def get_ordered_models():
             if app_label not in model_mapping.keys():
                 model_mapping[app_label] = []
             model_mapping[app_label].append(model_class)
+    return model_mapping
 
-    ordered_list_of_models = sort_dependencies(model_mapping)
+
+def get_ordered_models():
+    ordered_list_of_models = sort_dependencies(get_model_mapping())
     osf_models = list(apps.get_app_config('osf_models').get_models(include_auto_created=False))
 
     return [model for model in ordered_list_of_models if model in osf_models]
+
+
+def get_dependency_graph(models):
+    """Return a dict mapping each of ``models`` to the set of models in ``models``
+    that must be migrated before it.
+    """
+    model_dependencies = get_model_dependencies(get_model_mapping())
+    return {
+        model: set(dep for dep in deps if dep in models)
+        for model, deps in model_dependencies
+        if model in models
+    }
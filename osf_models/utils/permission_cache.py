@@ -0,0 +1,133 @@
+import threading
+import weakref
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+_local = threading.local()
+# Every PermissionCache alive, so that changes to contributors reach the ones held by Auths
+_caches = weakref.WeakSet()
+
+
+class PermissionCache(object):
+    """
+    Memoizes permission checks, keyed by (user pk, node pk, permission).
+
+    A user's entries are dropped when any of their Contributor records is saved or
+    deleted, since admin permissions on a node are inherited by its descendants. A
+    node's entries are dropped when it is saved.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        # (user pk, node pk, permission) -> bool
+        self._results = {}
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._results)
+
+    def __repr__(self):
+        return '<PermissionCache(size={}, hits={}, misses={})>'.format(len(self), self.hits, self.misses)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else None
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio,
+        }
+
+    def get_or_compute(self, user, node, permission, compute):
+        """Get the cached result of a check, or compute() and cache it."""
+        key = (user.pk if user else None, node.pk, permission)
+        try:
+            result = self._results[key]
+        except KeyError:
+            self.misses += 1
+            result = self._results[key] = compute()
+        else:
+            self.hits += 1
+        return result
+
+    def invalidate(self, user_id=None, node_id=None):
+        """Drop the entries for a user, a node, or with neither, everything."""
+        if user_id is None and node_id is None:
+            self._results.clear()
+            return
+        for key in list(self._results):
+            if key[0] == user_id or key[1] == node_id:
+                del self._results[key]
+
+
+def get_permission_cache(auth=None):
+    """The PermissionCache of auth if it has one, otherwise the one active on this thread."""
+    cache = getattr(auth, 'permission_cache', None)
+    if cache is not None:
+        return cache
+    return getattr(_local, 'cache', None)
+
+
+def check_permission(user, node, permission, compute, auth=None):
+    """Run compute(), memoized in the cache for auth or this thread, if there is one."""
+    cache = get_permission_cache(auth)
+    if cache is None or node.pk is None:
+        return compute()
+    return cache.get_or_compute(user, node, permission, compute)
+
+
+def invalidate_permissions(user=None, node=None):
+    """Drop cached permissions for user and/or node from every cache. With neither,
+    drop everything.
+    """
+    user_id = user.pk if user is not None else None
+    node_id = node.pk if node is not None else None
+    for cache in list(_caches):
+        cache.invalidate(user_id=user_id, node_id=node_id)
+
+
+class cached_permissions(object):
+    """
+    With block helper that memoizes permission checks made on this thread, e.g. for the
+    length of a request. Blocks can be nested; the innermost cache is used.
+
+    Usage:
+
+    with cached_permissions() as cache:
+        node.can_view(auth)
+        node.can_edit(auth)
+    print(cache.stats())
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else PermissionCache()
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'cache', None)
+        _local.cache = self.cache
+        return self.cache
+
+    def __exit__(self, type, value, traceback):
+        _local.cache = self.previous
+        self.previous = None
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_cached_permissions(sender, instance, **kwargs):
+    if not _caches:
+        return
+    label = instance._meta.concrete_model._meta.label
+    if label == 'osf_models.Contributor':
+        for cache in list(_caches):
+            cache.invalidate(user_id=instance.user_id)
+    elif label == 'osf_models.AbstractNode':
+        for cache in list(_caches):
+            cache.invalidate(node_id=instance.pk)
@@ -0,0 +1,77 @@
+from django.apps import apps
+from django.db.models import Q
+
+
+class PermissionResolver(object):
+    """
+    Answers permission questions for one user about a node, its ancestors and its
+    descendants, from a single query for the user's Contributor records on all of them.
+
+    Nodes outside of that tree fall back to the regular, per node queries.
+
+    Usage:
+
+    resolver = PermissionResolver(user, node)
+    for descendant in node.get_descendants_recursive():
+        if resolver.has_permission(descendant, 'write'):
+            ...
+    """
+
+    def __init__(self, user, node):
+        self.user = user
+        self.node = node
+        self._ancestor_ids = set(node._ancestor_ids)
+        # node pk -> Contributor, loaded on first use
+        self._contributors = None
+
+    def __repr__(self):
+        return '<PermissionResolver(user={!r}, node={!r})>'.format(self.user, self.node)
+
+    @property
+    def contributors(self):
+        if self._contributors is None:
+            Contributor = apps.get_model('osf_models.Contributor')
+            if self.user is None:
+                self._contributors = {}
+            else:
+                self._contributors = {
+                    contributor.node_id: contributor
+                    for contributor in Contributor.objects.filter(user=self.user).filter(
+                        Q(node_id__in=[self.node.pk] + list(self._ancestor_ids)) |
+                        Q(node__ancestor_ids__contains=[self.node.pk])
+                    )
+                }
+        return self._contributors
+
+    def covers(self, node):
+        """Whether node is in the tree this resolver loaded contributors for."""
+        return (
+            node.pk == self.node.pk or
+            node.pk in self._ancestor_ids or
+            self.node.pk in node._ancestor_ids
+        )
+
+    def has_permission(self, node, permission, check_parent=True):
+        """Like AbstractNode.has_permission."""
+        if not self.user:
+            return False
+        if not self.covers(node):
+            return node.has_permission(self.user, permission, check_parent=check_parent)
+        contributor = self.contributors.get(node.pk)
+        if contributor is None:
+            if permission == 'read' and check_parent:
+                return self.is_admin_parent(node)
+            return False
+        return bool(getattr(contributor, permission, False))
+
+    def is_admin_parent(self, node):
+        """Like AbstractNode.is_admin_parent."""
+        if not self.user:
+            return False
+        if not self.covers(node):
+            return node.is_admin_parent(self.user)
+        for pk in [node.pk] + node._ancestor_ids:
+            contributor = self.contributors.get(pk)
+            if contributor is not None and contributor.admin:
+                return True
+        return False